@@ -0,0 +1,293 @@
+# Handix
+# Teste de carga das rotas de entrada: retorno do paciente (handle_return) em rajadas e consultas do painel
+# (consultaLogs com combinações de filtros e consultaClientes) a uma taxa alvo de requisições por segundo.
+# Gera relatório de latência (p50/p95/p99), taxa de erro e espera do pool (via /metrics) para comparar versões.
+# Uso: python loadtest.py --url http://localhost:8080 --duracao 60 --rps-retorno 20 --rps-logs 5 --rps-clientes 1 --saida relatorio.json
+# coding: utf-8
+
+import json
+import random
+import asyncio
+import argparse
+from time import perf_counter
+from datetime import datetime, timedelta
+import aiohttp
+
+from config import TOKEN_BD, DATABASE_CONFIG
+
+# Combinações de filtros do painel (peso, filtros); os valores vêm de uma amostra do próprio consultaLogs
+MISTURA_LOGS = (
+    (40, ()),
+    (20, ('periodo',)),
+    (15, ('dominio',)),
+    (10, ('nomePaciente',)),
+    (10, ('numeroContato',)),
+    (5, ('agenda', 'periodo'))
+)
+
+def percentil(ordenados, q):
+    """Percentil q (0..1) de uma lista ordenada."""
+    return ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))]
+
+class Resultado:
+    """Latências e status das requisições de uma rota."""
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.latencias = []
+        self.status = {}
+        self.excecoes = 0
+        self.descartadas = 0
+
+    def registrar(self, latencia, status):
+        self.latencias.append(latencia)
+        self.status[status] = self.status.get(status, 0) + 1
+
+    def resumo(self, duracao):
+        ordenados = sorted(self.latencias)
+        total = len(ordenados) + self.excecoes
+        erros = self.excecoes + sum(quantidade for status, quantidade in self.status.items() if status >= 500)
+        resumo = {
+            'requisicoes': total,
+            'rps': round(total / duracao, 2) if duracao else 0,
+            'taxa_erro': round(erros / total, 4) if total else 0,
+            'status': {str(status): quantidade for status, quantidade in sorted(self.status.items())},
+            'excecoes': self.excecoes,
+            'descartadas': self.descartadas
+        }
+        if ordenados:
+            resumo.update({
+                'p50_ms': round(percentil(ordenados, 0.50) * 1000, 1),
+                'p95_ms': round(percentil(ordenados, 0.95) * 1000, 1),
+                'p99_ms': round(percentil(ordenados, 0.99) * 1000, 1),
+                'max_ms': round(ordenados[-1] * 1000, 1)
+            })
+        return resumo
+
+def ler_histogramas(texto, nome):
+    """Soma os baldes de um histograma do /metrics por (rótulos sem worker/le, limite)."""
+    baldes = {}
+    prefixo = nome + '_bucket{'
+    for linha in texto.splitlines():
+        if not linha.startswith(prefixo):
+            continue
+        rotulos, valor = linha[len(prefixo):].rsplit('} ', 1)
+        pares = dict(par.split('=', 1) for par in rotulos.split('",') if '=' in par)
+        pares = {chave: valor_rotulo.strip('"') for chave, valor_rotulo in pares.items()}
+        limite = float('inf') if pares['le'] == '+Inf' else float(pares['le'])
+        chave = tuple(sorted((k, v) for k, v in pares.items() if k not in ('le', 'worker')))
+        baldes.setdefault(chave, {})
+        baldes[chave][limite] = baldes[chave].get(limite, 0) + float(valor)
+    return baldes
+
+def percentis_histograma(antes, depois):
+    """Percentis aproximados (limite superior do balde; None acima do último) da diferença entre duas leituras de um histograma."""
+    resultado = {}
+    for chave, baldes in depois.items():
+        delta = sorted((limite, quantidade - antes.get(chave, {}).get(limite, 0)) for limite, quantidade in baldes.items())
+        total = delta[-1][1] if delta else 0
+        if total <= 0:
+            continue
+        def p(q):
+            for limite, acumulado in delta:
+                if acumulado >= q * total:
+                    return None if limite == float('inf') else round(limite * 1000, 1)
+        resultado[' '.join(f"{k}={v}" for k, v in chave) or 'total'] = {
+            'amostras': int(total), 'p50_ms_ate': p(0.50), 'p95_ms_ate': p(0.95), 'p99_ms_ate': p(0.99)
+        }
+    return resultado
+
+async def ler_metricas(session, url, token):
+    """Lê /metrics do servidor (None se indisponível)."""
+    headers = {'Authorization': f"Bearer {token}"} if token else {}
+    try:
+        async with session.get(f"{url}/metrics", headers=headers) as response:
+            if response.status == 200:
+                return await response.text()
+    except aiohttp.ClientError:
+        pass
+    return None
+
+async def amostrar_filtros(session, url):
+    """Valores reais para os filtros do consultaLogs e tokens Gesthor, a partir do consultaClientes e da primeira página sem filtro."""
+    headers = {'Authorization': f"Bearer {TOKEN_BD}"}
+    async with session.get(f"{url}/consultaClientes", headers=headers) as response:
+        clientes = (await response.json(content_type=None)).get('data') or []
+    async with session.get(f"{url}/consultaLogs", params={'limit': '200'}, headers=headers) as response:
+        linhas = (await response.json(content_type=None)).get('data') or []
+    return {
+        'dominio': sorted({cliente['dominio_omniplus'] for cliente in clientes if cliente.get('dominio_omniplus')}),
+        'tokens': sorted({cliente['bearer_gesthor'] for cliente in clientes if cliente.get('bearer_gesthor')}),
+        'nomePaciente': sorted({linha['nome_paciente'].split(' ')[0] for linha in linhas if linha.get('nome_paciente')}),
+        'numeroContato': sorted({''.join(filter(str.isdigit, linha['numero_contato_formatado'])) for linha in linhas if linha.get('numero_contato_formatado')}),
+        'agenda': sorted({str(linha['agenda']) for linha in linhas if linha.get('agenda') is not None})
+    }
+
+def montar_filtros(aleatorio, campos, amostra):
+    """Parâmetros de uma consulta do painel com os campos sorteados."""
+    params = {'limit': '100'}
+    for campo in campos:
+        if campo == 'periodo':
+            hoje = datetime.now().date()
+            params['dataInicio'] = (hoje - timedelta(days=aleatorio.choice((1, 7, 30)))).isoformat()
+            params['dataFim'] = hoje.isoformat()
+        elif amostra.get(campo):
+            params[campo] = aleatorio.choice(amostra[campo])
+    return params
+
+async def carregar_pendentes(dsn):
+    """Registros aguardando resposta (status 1) e o token do cliente, para o modo --retorno pendentes."""
+    import asyncpg
+    connection = await asyncpg.connect(dsn)
+    try:
+        rows = await connection.fetch("""
+            SELECT c.numero_contato, t.bearer_gesthor
+            FROM tb_controle c
+            JOIN tb_cliente t ON t.dominio_gesthor = c.url_origem
+            WHERE c.status = 1
+        """)
+    finally:
+        await connection.close()
+    return [(str(row['numero_contato']), row['bearer_gesthor']) for row in rows]
+
+def horarios_rajadas(aleatorio, duracao, rps_base, rajadas, tamanho, duracao_rajada):
+    """Instantes (segundos desde o início) das respostas: fluxo base mais rajadas em horários sorteados."""
+    instantes = [indice / rps_base for indice in range(int(duracao * rps_base))] if rps_base > 0 else []
+    for _ in range(rajadas):
+        inicio = aleatorio.uniform(0, max(duracao - duracao_rajada, 0))
+        # Respostas de uma rajada chegam concentradas no começo (distribuição exponencial)
+        instantes.extend(min(inicio + aleatorio.expovariate(3 / duracao_rajada), duracao) for _ in range(tamanho))
+    return sorted(instantes)
+
+async def disparar(instantes, resultado, max_em_voo, requisicao):
+    """Dispara as requisições nos instantes previstos (laço aberto), sem esperar as anteriores."""
+    inicio = perf_counter()
+    em_voo = set()
+    for indice, instante in enumerate(instantes):
+        espera = instante - (perf_counter() - inicio)
+        if espera > 0:
+            await asyncio.sleep(espera)
+        if len(em_voo) >= max_em_voo:
+            # Servidor saturado: a requisição é contada como descartada em vez de atrasar as seguintes
+            resultado.descartadas += 1
+            continue
+        tarefa = asyncio.create_task(requisicao(indice))
+        em_voo.add(tarefa)
+        tarefa.add_done_callback(em_voo.discard)
+    if em_voo:
+        await asyncio.gather(*em_voo, return_exceptions=True)
+
+async def medir(session, resultado, metodo, url, **kwargs):
+    """Executa uma requisição e registra latência e status."""
+    inicio = perf_counter()
+    try:
+        async with session.request(metodo, url, **kwargs) as response:
+            await response.read()
+            resultado.registrar(perf_counter() - inicio, response.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        resultado.excecoes += 1
+
+async def executar(args):
+    """Executa a carga configurada e imprime (e opcionalmente grava) o relatório."""
+    aleatorio = random.Random(args.semente)
+    conector = aiohttp.TCPConnector(limit=args.max_em_voo * 3)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout) as session:
+        amostra = await amostrar_filtros(session, args.url)
+
+        if args.retorno == 'pendentes':
+            pendentes = await carregar_pendentes(args.dsn)
+            aleatorio.shuffle(pendentes)
+        else:
+            pendentes = []
+
+        retorno = Resultado('handle_return')
+        logs = Resultado('consultaLogs')
+        clientes = Resultado('consultaClientes')
+        painel = {'Authorization': f"Bearer {TOKEN_BD}"}
+        pesos = [peso for peso, _ in MISTURA_LOGS]
+        campos_logs = [campos for _, campos in MISTURA_LOGS]
+
+        async def responder(indice):
+            if pendentes:
+                if indice >= len(pendentes):
+                    retorno.descartadas += 1
+                    return
+                numero, token = pendentes[indice]
+            else:
+                # Número inexistente: percorre autenticação e a busca indexada sem alterar dados (404 esperado)
+                numero = str(aleatorio.randint(5500000000000, 5599999999999))
+                token = args.token_gesthor or (aleatorio.choice(amostra['tokens']) if amostra['tokens'] else 'inexistente')
+            await medir(session, retorno, 'POST', f"{args.url}/api/v1/template/return",
+                        json={'numero': f"+{numero}", 'confirma': aleatorio.choice(('sim', 'nao'))},
+                        headers={'Authorization': f"Bearer {token}"})
+
+        async def consultar_logs(indice):
+            campos = aleatorio.choices(campos_logs, weights=pesos)[0]
+            await medir(session, logs, 'GET', f"{args.url}/consultaLogs", params=montar_filtros(aleatorio, campos, amostra), headers=painel)
+
+        async def consultar_clientes(indice):
+            await medir(session, clientes, 'GET', f"{args.url}/consultaClientes", headers=painel)
+
+        metricas_antes = await ler_metricas(session, args.url, args.token_metricas)
+        inicio = perf_counter()
+        await asyncio.gather(
+            disparar(horarios_rajadas(aleatorio, args.duracao, args.rps_retorno, args.rajadas, args.rajada_tamanho, args.rajada_duracao),
+                     retorno, args.max_em_voo, responder),
+            disparar([indice / args.rps_logs for indice in range(int(args.duracao * args.rps_logs))] if args.rps_logs > 0 else [],
+                     logs, args.max_em_voo, consultar_logs),
+            disparar([indice / args.rps_clientes for indice in range(int(args.duracao * args.rps_clientes))] if args.rps_clientes > 0 else [],
+                     clientes, args.max_em_voo, consultar_clientes)
+        )
+        duracao = perf_counter() - inicio
+        metricas_depois = await ler_metricas(session, args.url, args.token_metricas)
+
+    relatorio = {
+        'executado_em': datetime.now().isoformat(timespec='seconds'),
+        'url': args.url,
+        'parametros': {chave: valor for chave, valor in vars(args).items() if chave not in ('token_gesthor', 'token_metricas', 'dsn')},
+        'duracao_s': round(duracao, 2),
+        'rotas': {resultado.nome: resultado.resumo(duracao) for resultado in (retorno, logs, clientes)}
+    }
+    if metricas_antes and metricas_depois:
+        # Com --workers o /metrics responde por um processo: os valores são daquele worker
+        relatorio['espera_pool'] = percentis_histograma(ler_histogramas(metricas_antes, 'igo_pool_aquisicao_segundos'),
+                                                        ler_histogramas(metricas_depois, 'igo_pool_aquisicao_segundos'))
+        relatorio['rotas_servidor'] = percentis_histograma(ler_histogramas(metricas_antes, 'igo_rota_segundos'),
+                                                           ler_histogramas(metricas_depois, 'igo_rota_segundos'))
+
+    print(f"Duração: {relatorio['duracao_s']} s")
+    for nome, resumo in relatorio['rotas'].items():
+        if not resumo['requisicoes']:
+            continue
+        print(f"  {nome:<18} {resumo['requisicoes']:>7} req  {resumo['rps']:>8} req/s  erro {resumo['taxa_erro']:.2%}  "
+              f"p50 {resumo.get('p50_ms')} ms  p95 {resumo.get('p95_ms')} ms  p99 {resumo.get('p99_ms')} ms  "
+              f"status {resumo['status']}  descartadas {resumo['descartadas']}")
+    for nome, valores in relatorio.get('espera_pool', {}).items():
+        print(f"  espera do pool ({nome}): {valores}")
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(relatorio, arquivo, ensure_ascii=False, indent=2)
+        print(f"Relatório gravado em {args.saida}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga das rotas de entrada do Middleware Handix")
+    parser.add_argument('--url', default='http://localhost:8080', help="endereço do middleware")
+    parser.add_argument('--duracao', type=float, default=60, help="duração da carga (segundos)")
+    parser.add_argument('--rps-retorno', type=float, default=10, help="respostas de pacientes por segundo fora das rajadas")
+    parser.add_argument('--rajadas', type=int, default=3, help="quantidade de rajadas de respostas")
+    parser.add_argument('--rajada-tamanho', type=int, default=300, help="respostas por rajada")
+    parser.add_argument('--rajada-duracao', type=float, default=10, help="duração (segundos) de cada rajada")
+    parser.add_argument('--rps-logs', type=float, default=5, help="consultas por segundo ao consultaLogs")
+    parser.add_argument('--rps-clientes', type=float, default=1, help="consultas por segundo ao consultaClientes")
+    parser.add_argument('--retorno', choices=('inexistente', 'pendentes'), default='inexistente',
+                        help="inexistente: números sem registro (404, não altera dados); pendentes: responde os registros com status 1 (altera dados e envia ao Gesthor)")
+    parser.add_argument('--token-gesthor', default='', help="token Gesthor usado no modo inexistente (padrão: tokens do consultaClientes)")
+    parser.add_argument('--dsn', default=DATABASE_CONFIG['dsn'], help="banco para ler os registros pendentes (modo pendentes)")
+    parser.add_argument('--token-metricas', default=None, help="bearer de /metrics, se METRICAS_TOKEN estiver definido")
+    parser.add_argument('--max-em-voo', type=int, default=500, help="requisições simultâneas por rota antes de descartar")
+    parser.add_argument('--timeout', type=float, default=30, help="tempo limite (segundos) de cada requisição")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', help="arquivo JSON do relatório")
+    asyncio.run(executar(parser.parse_args()))
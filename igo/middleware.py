@@ -3,19 +3,227 @@
 # coding: utf-8
 
 import os
+import re
+import io
+import csv
+import zlib
+import heapq
+import gzip
+import json
+import argparse
+import base64
 import shutil
 import asyncio
+import multiprocessing
+from urllib.parse import urlsplit
 from aiohttp import web
 import aiohttp
 import asyncpg
 import logging
+import logging.handlers
+import queue
+import atexit
+import copy
+import secrets
+import contextvars
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from time import perf_counter
 from datetime import datetime, timedelta, date, time
-from config import DATABASE_CONFIG, LOG_LEVEL, LOG_FILE, TOKEN_BD
-import aiofiles
+from config import DATABASE_CONFIG, LOG_LEVEL, LOG_FILE, LOG_DIR_ARQUIVO, LOG_ROTACAO_TAMANHO, LOG_ROTACAO_DIAS, LOG_FORMATO, TOKEN_BD, MAX_CLIENTES_PARALELOS, TIMEOUT_CLIENTE, GESTHOR_MAX_REQUISICOES_PARALELAS, GESTHOR_MAX_TENTATIVAS, GESTHOR_ESPERA_RETRY, GESTHOR_ESPERA_RETRY_MAX
+from config import FILA_ESCUTAR_NOTIFY, FILA_CANAL_NOTIFY, FILA_INTERVALO, FILA_INTERVALO_FALLBACK, FILA_AGRUPAMENTO
+from config import OMNIPLUS_MAX_ENVIOS_POR_DOMINIO, OMNIPLUS_MAX_ENVIOS_POR_CANAL, LOTE_ENVIO, FILA_RESERVA
+from config import HTTP_SESSOES, HTTP_TTL_DNS, HTTP_KEEPALIVE, GESTHOR_ESQUEMA, OMNIPLUS_ESQUEMA
+from config import CHAMADAS_EXTERNAS, CHAMADAS_EXTERNAS_DOMINIOS, CIRCUITO_FALHAS, CIRCUITO_ABERTO, CIRCUITO_SONDAS
+from config import WORKERS, LIDER_CHAVE, LIDER_INTERVALO
+from config import METRICAS_TOKEN, METRICAS_FILA_INTERVALO
+from config import LOGS_EXPORTACAO_LOTE, LOGS_LIMITE_MAXIMO
+from config import AGENDADOR_ESPALHAMENTO, AGENDADOR_RECUPERACAO, AGENDADOR_VERIFICACAO
+from config import CONFIG_CLIENTES_CANAL_NOTIFY, CONFIG_CLIENTES_INTERVALO, CONFIG_CLIENTES_RECARGA_MINIMA
+from config import GESTHOR_OUTBOX_LOTE, GESTHOR_OUTBOX_INTERVALO, GESTHOR_OUTBOX_RESERVA, GESTHOR_OUTBOX_MAX_TENTATIVAS, GESTHOR_OUTBOX_BACKOFF, GESTHOR_OUTBOX_BACKOFF_MAX
+from config import LOG_PARTICOES_ADIANTE, LOG_PARTICOES_INTERVALO, LOG_RETENCAO_MESES, LOG_RETENCAO_EXPORTAR, LOG_RETENCAO_DIR, LOG_RETENCAO_APAGAR
+from config import CACHE_PACIENTE_MAX_ITENS, CACHE_PACIENTE_TTL, CACHE_PACIENTE_PERSISTENTE
 from decimal import Decimal
+from collections import OrderedDict
+from types import MappingProxyType
+
+try:
+    import orjson  # Opcional: serialização JSON mais rápida
+except ImportError:
+    orjson = None
+
+# Serialização JSON das respostas e das integrações: orjson quando instalado, json da biblioteca padrão como alternativa
+def valor_json(valor):
+    """Converte os tipos sem representação JSON direta (Decimal, Record, datetime/date no json padrão)."""
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, asyncpg.Record):
+        return dict(valor)
+    if isinstance(valor, (datetime, date, time)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo não serializável em JSON: {type(valor).__name__}")
+
+if orjson is not None:
+    def serializar_json(dados):
+        """Serializa para JSON (bytes UTF-8)."""
+        return orjson.dumps(dados, default=valor_json)
+
+    carregar_json = orjson.loads
+else:
+    def serializar_json(dados):
+        """Serializa para JSON (bytes UTF-8)."""
+        return json.dumps(dados, default=valor_json, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    carregar_json = json.loads
+
+def resposta_json(dados, status=200, headers=None):
+    """Resposta JSON serializada por serializar_json (substitui web.json_response)."""
+    return web.Response(body=serializar_json(dados), status=status, headers=headers, content_type='application/json')
 
 # Configuração de log
-logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+class ArquivoLogRotativo(logging.handlers.TimedRotatingFileHandler):
+    """Arquivo de log rotacionado à meia-noite e por tamanho; o arquivo rotacionado é compactado (gzip) no diretório de arquivamento."""
+
+    def __init__(self, arquivo, diretorio_arquivo, tamanho_maximo, dias_retencao):
+        super().__init__(arquivo, when='midnight', backupCount=0, encoding='utf-8', delay=True)
+        self.diretorio_arquivo = diretorio_arquivo
+        self.tamanho_maximo = tamanho_maximo
+        self.dias_retencao = dias_retencao
+        self.prefixo_arquivo = os.path.basename(arquivo) + '_'
+
+    def shouldRollover(self, record):
+        """Rotaciona na virada do dia ou quando o arquivo atinge o tamanho máximo."""
+        if super().shouldRollover(record):
+            return True
+        if self.tamanho_maximo <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.tamanho_maximo
+
+    def rotation_filename(self, default_name):
+        """middleware.log.aaaa-mm-dd -> diretório de arquivamento/middleware.log_aaaa-mm-dd[.n].gz, sem sobrescrever."""
+        sufixo = default_name[len(self.baseFilename) + 1:]
+        base = os.path.join(self.diretorio_arquivo, self.prefixo_arquivo + sufixo)
+        destino = base + '.gz'
+        sequencia = 1
+        while os.path.exists(destino):
+            destino = f"{base}.{sequencia}.gz"
+            sequencia += 1
+        return destino
+
+    def rotate(self, source, dest):
+        """Compacta o arquivo rotacionado e apaga os arquivos fora da retenção (thread do QueueListener)."""
+        os.makedirs(self.diretorio_arquivo, exist_ok=True)
+        with open(source, 'rb') as entrada, gzip.open(dest, 'wb') as saida:
+            shutil.copyfileobj(entrada, saida)
+        os.remove(source)
+
+        limite = datetime.now().timestamp() - self.dias_retencao * 86400
+        for nome in os.listdir(self.diretorio_arquivo):
+            caminho = os.path.join(self.diretorio_arquivo, nome)
+            if nome.startswith(self.prefixo_arquivo) and os.path.getmtime(caminho) < limite:
+                os.remove(caminho)
+
+# Campos de correlação (id_requisicao, id_execucao, cliente, id_lote...) herdados pelas tarefas asyncio
+contexto_log = contextvars.ContextVar('contexto_log', default=MappingProxyType({}))
+
+def novo_id_log():
+    """Gera um identificador curto de correlação."""
+    return secrets.token_hex(8)
+
+@contextmanager
+def campos_log(**campos):
+    """Acrescenta campos de correlação a todos os logs emitidos dentro do bloco (e pelas tarefas criadas nele)."""
+    token = contexto_log.set(MappingProxyType({**contexto_log.get(), **campos}))
+    try:
+        yield
+    finally:
+        contexto_log.reset(token)
+
+class FilaLogHandler(logging.handlers.QueueHandler):
+    """Enfileira o registro com a mensagem já montada e os campos de correlação da tarefa que o emitiu."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.contexto = contexto_log.get()
+        return record
+
+class FormatadorJson(logging.Formatter):
+    """Uma linha JSON por evento: horário, nível, mensagem, campos de correlação e dados do evento (extra=)."""
+
+    def format(self, record):
+        evento = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'msg': record.getMessage()
+        }
+        evento.update(getattr(record, 'contexto', {}))
+        if getattr(record, 'evento', None):
+            evento['evento'] = record.evento
+        if getattr(record, 'dados', None):
+            evento['dados'] = record.dados
+        if record.exc_text:
+            evento['erro'] = record.exc_text
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+class FormatadorTexto(logging.Formatter):
+    """Formato texto com os campos de correlação ao final da linha."""
+
+    def format(self, record):
+        linha = super().format(record)
+        contexto = getattr(record, 'contexto', None)
+        if contexto:
+            linha += ' [' + ' '.join(f"{chave}={valor}" for chave, valor in contexto.items()) + ']'
+        if getattr(record, 'dados', None):
+            linha += ' ' + json.dumps(record.dados, ensure_ascii=False, default=str)
+        return linha
+
+# Listener que grava os logs em uma thread própria; o loop de eventos só enfileira
+ouvinte_log = None
+
+def configurar_log(arquivo=LOG_FILE):
+    """Direciona os logs para uma fila gravada em segundo plano no arquivo rotativo."""
+    global ouvinte_log
+    if ouvinte_log is not None:
+        ouvinte_log.stop()
+
+    os.makedirs(os.path.dirname(os.path.abspath(arquivo)), exist_ok=True)
+    arquivo_log = ArquivoLogRotativo(arquivo, LOG_DIR_ARQUIVO, LOG_ROTACAO_TAMANHO, LOG_ROTACAO_DIAS)
+    if LOG_FORMATO == 'json':
+        arquivo_log.setFormatter(FormatadorJson())
+    else:
+        arquivo_log.setFormatter(FormatadorTexto('%(asctime)s - %(levelname)s - %(message)s'))
+
+    fila = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+        handler.close()
+    raiz.addHandler(FilaLogHandler(fila))
+    raiz.setLevel(LOG_LEVEL)
+
+    ouvinte_log = logging.handlers.QueueListener(fila, arquivo_log, respect_handler_level=True)
+    ouvinte_log.start()
+
+def encerrar_log():
+    """Grava os logs pendentes na fila e fecha o arquivo."""
+    global ouvinte_log
+    if ouvinte_log is not None:
+        ouvinte_log.stop()
+        for handler in ouvinte_log.handlers:
+            handler.close()
+        ouvinte_log = None
+
+configurar_log()
+atexit.register(encerrar_log)
 
 @web.middleware
 async def cors_middleware(request, handler):
@@ -31,87 +239,647 @@ async def cors_middleware(request, handler):
 
     # Continua o processamento normal para outros métodos HTTP
     response = await handler(request)
+    if response.prepared:
+        return response  # Exportação em andamento: cabeçalhos já enviados pelo próprio handler
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     return response
 
-app = web.Application(middlewares=[cors_middleware])
+# Métricas (formato texto do Prometheus), mantidas em memória por processo
+def escapar_rotulo(valor):
+    """Escapa barra invertida, aspas e quebra de linha no valor de um rótulo."""
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def rotulos_texto(nomes, valores, extra=None):
+    """Monta {nome="valor",...}; extra acrescenta mais um par (nome, valor), ex.: le do histograma."""
+    pares = ['%s="%s"' % (nome, escapar_rotulo(valor)) for nome, valor in zip(nomes, valores)]
+    if extra is not None:
+        pares.append('%s="%s"' % extra)
+    return '{' + ','.join(pares) + '}' if pares else ''
+
+class Metrica:
+    """Série de valores de uma métrica, um por combinação de rótulos."""
+    tipo = 'untyped'
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = ('worker',) + tuple(rotulos)
+        self.valores = {}
+
+    def chave(self, rotulos):
+        return (worker_atual,) + tuple(rotulos[nome] for nome in self.rotulos[1:])
+
+    def linhas(self):
+        yield f"# HELP {self.nome} {self.ajuda}"
+        yield f"# TYPE {self.nome} {self.tipo}"
+        for chave, valor in sorted(self.valores.items()):
+            yield f"{self.nome}{rotulos_texto(self.rotulos, chave)} {valor}"
+
+class Medidor(Metrica):
+    tipo = 'gauge'
+
+    def definir(self, valor, **rotulos):
+        self.valores[self.chave(rotulos)] = valor
+
+class Histograma(Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nome, ajuda, rotulos=(), limites=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(nome, ajuda, rotulos)
+        self.limites = tuple(limites)
+
+    def observar(self, valor, **rotulos):
+        chave = self.chave(rotulos)
+        serie = self.valores.get(chave)
+        if serie is None:
+            serie = self.valores[chave] = [[0] * len(self.limites), 0.0, 0]
+        for indice, limite in enumerate(self.limites):
+            if valor <= limite:
+                serie[0][indice] += 1
+        serie[1] += valor
+        serie[2] += 1
+
+    def linhas(self):
+        yield f"# HELP {self.nome} {self.ajuda}"
+        yield f"# TYPE {self.nome} {self.tipo}"
+        for chave, (baldes, soma, contagem) in sorted(self.valores.items()):
+            for limite, quantidade in zip(self.limites, baldes):
+                yield f"{self.nome}_bucket{rotulos_texto(self.rotulos, chave, ('le', limite))} {quantidade}"
+            yield f"{self.nome}_bucket{rotulos_texto(self.rotulos, chave, ('le', '+Inf'))} {contagem}"
+            yield f"{self.nome}_sum{rotulos_texto(self.rotulos, chave)} {soma}"
+            yield f"{self.nome}_count{rotulos_texto(self.rotulos, chave)} {contagem}"
+
+# Worker que responde as métricas (0 com um único processo, 1..N com --workers)
+worker_atual = 0
+
+metricas_chamadas = Histograma('igo_chamada_externa_segundos', 'Duração das chamadas ao Gesthor e ao Omniplus.', ('integracao', 'operacao', 'resultado'))
+metricas_rotas = Histograma('igo_rota_segundos', 'Duração do atendimento das rotas HTTP.', ('rota', 'metodo', 'status'))
+metricas_pool = Histograma('igo_pool_aquisicao_segundos', 'Espera para obter uma conexão do pool do banco.', (),
+                           limites=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+metricas_execucoes = Histograma('igo_execucao_cliente_segundos', 'Duração da sincronização de um cliente com o Gesthor.', ('periodo', 'resultado'),
+                                limites=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800))
+metricas_pool_conexoes = Medidor('igo_pool_conexoes', 'Conexões do pool do banco por situação.', ('situacao',))
+metricas_fila = Medidor('igo_fila_registros', 'Registros de tb_controle a enviar (0) e em envio (4) a partir de hoje.', ('status',))
+metricas_outbox = Medidor('igo_outbox_gesthor_pendentes', 'Confirmações pendentes no outbox do Gesthor.')
+metricas_lider = Medidor('igo_lider', '1 quando o processo é o líder (agendador e manutenção de tb_log).')
+METRICAS = (metricas_chamadas, metricas_rotas, metricas_pool, metricas_execucoes, metricas_pool_conexoes, metricas_fila, metricas_outbox, metricas_lider)
+
+def medir_chamada(integracao, operacao):
+    """Decorador que registra a duração e o resultado de uma chamada externa.
+
+    operacao: nome fixo ou função que o obtém dos argumentos da chamada (ex.: endpoint da URL).
+    erro: exceção; falha: a função sinalizou falha (None ou False); ok: qualquer outro retorno, inclusive vazio ([] de um dia sem agendamentos).
+    """
+    def decorador(funcao):
+        @wraps(funcao)
+        async def medida(*args, **kwargs):
+            nome_operacao = operacao(*args, **kwargs) if callable(operacao) else operacao
+            inicio = perf_counter()
+            resultado = 'erro'
+            try:
+                retorno = await funcao(*args, **kwargs)
+                resultado = 'falha' if retorno is None or retorno is False else 'ok'
+                return retorno
+            finally:
+                metricas_chamadas.observar(perf_counter() - inicio, integracao=integracao, operacao=nome_operacao, resultado=resultado)
+        return medida
+    return decorador
+
+class AquisicaoMedida:
+    """Aquisição de conexão do pool que registra o tempo de espera."""
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conexao = None
+
+    async def __aenter__(self):
+        inicio = perf_counter()
+        self.conexao = await self.pool.acquire(timeout=self.timeout)
+        metricas_pool.observar(perf_counter() - inicio)
+        return self.conexao
+
+    async def __aexit__(self, tipo, erro, tb):
+        await self.pool.release(self.conexao)
+        return False
+
+class PoolMedido:
+    """Pool asyncpg com a espera das aquisições medida; os demais atributos são os do pool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def acquire(self, *, timeout=None):
+        return AquisicaoMedida(self.pool, timeout)
+
+    def __getattr__(self, nome):
+        return getattr(self.pool, nome)
+
+@web.middleware
+async def metricas_middleware(request, handler):
+    """Registra a duração e o status de cada rota HTTP."""
+    recurso = request.match_info.route.resource
+    rota = recurso.canonical if recurso is not None else 'desconhecida'
+    inicio = perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metricas_rotas.observar(perf_counter() - inicio, rota=rota, metodo=request.method, status=status)
+
+async def atualizar_metricas_fila(app):
+    """Consulta a profundidade da fila de envio e do outbox, no máximo uma vez a cada METRICAS_FILA_INTERVALO."""
+    agora = asyncio.get_running_loop().time()
+    if agora - app.get('metricas_fila_em', float('-inf')) < METRICAS_FILA_INTERVALO:
+        return
+    app['metricas_fila_em'] = agora
+    async with app['db'].acquire() as connection:
+        rows = await connection.fetch("""
+            SELECT status, count(*) AS total
+            FROM tb_controle
+            WHERE status IN (0, 4) AND data_agendamento >= CURRENT_DATE
+            GROUP BY status
+        """)
+        pendentes = await connection.fetchval("SELECT count(*) FROM tb_outbox_gesthor WHERE situacao = 'pendente'")
+    totais = {row['status']: row['total'] for row in rows}
+    for status in (0, 4):
+        metricas_fila.definir(totais.get(status, 0), status=status)
+    metricas_outbox.definir(pendentes)
+
+async def metrics(request):
+    """Expõe as métricas do processo no formato texto do Prometheus."""
+    if METRICAS_TOKEN is not None:
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
+        if token != METRICAS_TOKEN:
+            return web.Response(status=401, text="Invalid token.")
+
+    app = request.app
+    pool = app['db']
+    metricas_pool_conexoes.definir(pool.get_size(), situacao='abertas')
+    metricas_pool_conexoes.definir(pool.get_idle_size(), situacao='ociosas')
+    metricas_pool_conexoes.definir(pool.get_size() - pool.get_idle_size(), situacao='em_uso')
+    metricas_pool_conexoes.definir(pool.get_max_size(), situacao='maximo')
+    metricas_lider.definir(1 if app.get('lider') else 0)
+    try:
+        await atualizar_metricas_fila(app)
+    except Exception as e:
+        logging.error("Erro ao consultar a profundidade da fila para as métricas: %s", e)
+
+    linhas = []
+    for metrica in METRICAS:
+        linhas.extend(metrica.linhas())
+    return web.Response(text='\n'.join(linhas) + '\n', content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+@web.middleware
+async def id_requisicao_middleware(request, handler):
+    """Identifica a requisição (X-Request-ID recebido ou novo) em todos os logs emitidos durante o seu atendimento."""
+    id_requisicao = request.headers.get('X-Request-ID') or novo_id_log()
+    with campos_log(id_requisicao=id_requisicao, rota=request.path):
+        response = await handler(request)
+    if not response.prepared:
+        response.headers['X-Request-ID'] = id_requisicao
+    return response
+
+app = web.Application(middlewares=[id_requisicao_middleware, metricas_middleware, cors_middleware])
 
 async def init_db(app):
     """Inicializa a conexão com o banco de dados e adiciona ao aplicativo."""
-    logging.debug(f"Inicializa a conexão com o banco de dados e adiciona ao aplicativo")
+    logging.debug("Inicializa a conexão com o banco de dados e adiciona ao aplicativo")
     try:
         # Usa as configurações do arquivo config.py
-        app['db'] = await asyncpg.create_pool(dsn=DATABASE_CONFIG['dsn'])
+        app['db'] = PoolMedido(await asyncpg.create_pool(**DATABASE_CONFIG))  # Mede a espera de cada acquire
+        await config_clientes.carregar(app['db'])
         logging.info("Conexão com o banco de dados inicializada com sucesso.")
     except Exception as e:
-        logging.error(f"Erro ao inicializar o pool de conexões do banco de dados: {e}")
+        logging.error("Erro ao inicializar o pool de conexões do banco de dados: %s", e)
         raise web.HTTPInternalServerError(reason=f"Erro ao inicializar o pool de conexões: {e}")
 
 async def close_db(app):
     """Fecha o pool de conexões com o banco de dados."""
-    logging.error(f"Fecha o pool de conexões com o banco de dados")
+    logging.error("Fecha o pool de conexões com o banco de dados")
     try:
         await app['db'].close()
         logging.info("Conexão com o banco de dados fechada com sucesso.")
     except Exception as e:
-        logging.error(f"Erro ao fechar o pool de conexões do banco de dados: {e}")
+        logging.error("Erro ao fechar o pool de conexões do banco de dados: %s", e)
+
+class RegistroSessoesHttp:
+    """Sessões aiohttp de longa duração, uma por integração (Gesthor, Omniplus), reaproveitando conexões keep-alive."""
+
+    def __init__(self):
+        self.sessoes = {}
+
+    async def iniciar(self, configuracoes, resolver=None):
+        """Cria uma sessão com conector próprio para cada integração configurada (resolver opcional, ex.: benchmark.py)."""
+        for nome, cfg in configuracoes.items():
+            connector = aiohttp.TCPConnector(
+                limit=cfg['limite'],
+                limit_per_host=cfg['limite_por_host'],
+                ttl_dns_cache=HTTP_TTL_DNS,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                resolver=resolver
+            )
+            timeout = aiohttp.ClientTimeout(total=cfg['timeout_total'], connect=cfg['timeout_conexao'])
+            self.sessoes[nome] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            logging.info("Sessão HTTP '%s' criada: limite %s, por host %s, timeout %ss.", nome, cfg['limite'], cfg['limite_por_host'], cfg['timeout_total'])
+
+    def obter(self, nome):
+        """Retorna a sessão de uma integração."""
+        sessao = self.sessoes.get(nome)
+        if sessao is None or sessao.closed:
+            raise RuntimeError(f"Sessão HTTP '{nome}' não foi iniciada.")
+        return sessao
+
+    async def fechar(self):
+        """Fecha todas as sessões e seus conectores."""
+        for nome, sessao in self.sessoes.items():
+            if not sessao.closed:
+                await sessao.close()
+        self.sessoes = {}
+
+# Registro de sessões HTTP compartilhado por todas as chamadas ao Gesthor e ao Omniplus
+sessoes_http = RegistroSessoesHttp()
+
+async def iniciar_sessoes_http(app):
+    """Cria as sessões HTTP compartilhadas ao iniciar o servidor."""
+    logging.debug("Cria as sessões HTTP compartilhadas ao iniciar o servidor.")
+    await sessoes_http.iniciar(HTTP_SESSOES)
+    app['http'] = sessoes_http
+
+async def fechar_sessoes_http(app):
+    """Fecha as sessões HTTP compartilhadas ao parar o servidor."""
+    logging.debug("Fecha as sessões HTTP compartilhadas ao parar o servidor.")
+    try:
+        await sessoes_http.fechar()
+        logging.info("Sessões HTTP fechadas com sucesso.")
+    except Exception as e:
+        logging.error("Erro ao fechar as sessões HTTP: %s", e)
+
+class CircuitoAberto(Exception):
+    """Chamada recusada porque o circuito do domínio está aberto."""
+
+class ControleDominio:
+    """Token bucket e circuit breaker das chamadas a um domínio (fechado -> aberto -> meio_aberto -> fechado)."""
+
+    def __init__(self, integracao, dominio, taxa, rajada):
+        self.integracao = integracao
+        self.dominio = dominio
+        self.taxa = taxa
+        self.rajada = rajada
+        self.tokens = float(rajada)
+        self.atualizado = None
+        self.estado = 'fechado'
+        self.falhas_seguidas = 0
+        self.aberto_em = None
+        self.sondas = 0
+        self.contadores = {'chamadas': 0, 'sucessos': 0, 'falhas': 0, 'timeouts': 0, 'recusadas': 0, 'aguardaram_token': 0, 'aberturas': 0}
+
+    def verificar_circuito(self, agora):
+        """Recusa a chamada com o circuito aberto; vencido o tempo aberto, libera as sondas."""
+        if self.estado == 'aberto' and agora - self.aberto_em >= CIRCUITO_ABERTO:
+            self.estado = 'meio_aberto'
+            logging.info("Circuito %s %s meio aberto, liberando sondas.", self.integracao, self.dominio)
+        if self.estado == 'aberto' or (self.estado == 'meio_aberto' and self.sondas >= CIRCUITO_SONDAS):
+            self.contadores['recusadas'] += 1
+            raise CircuitoAberto(f"Circuito {self.integracao} {self.dominio} aberto.")
+
+    async def entrar(self):
+        """Aguarda um token do domínio e reserva a chamada (ou sonda) se o circuito permitir."""
+        loop = asyncio.get_running_loop()
+        self.verificar_circuito(loop.time())
+        aguardou = False
+        while True:
+            agora = loop.time()
+            if self.atualizado is not None:
+                self.tokens = min(self.rajada, self.tokens + (agora - self.atualizado) * self.taxa)
+            self.atualizado = agora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                break
+            aguardou = True
+            await asyncio.sleep((1 - self.tokens) / self.taxa)
+        if aguardou:
+            self.contadores['aguardaram_token'] += 1
+        # O circuito pode ter aberto durante a espera pelo token
+        self.verificar_circuito(loop.time())
+        if self.estado == 'meio_aberto':
+            self.sondas += 1
+        self.contadores['chamadas'] += 1
+
+    def sair(self, sonda, resultado):
+        """Registra o resultado da chamada ('sucesso', 'falha', 'timeout' ou None quando não conta) e atualiza o circuito."""
+        if sonda:
+            self.sondas -= 1
+        if resultado is None:
+            return
+        if resultado == 'sucesso':
+            self.contadores['sucessos'] += 1
+            if self.estado == 'fechado':
+                self.falhas_seguidas = 0
+            elif self.estado == 'meio_aberto' and sonda:
+                self.estado = 'fechado'
+                self.falhas_seguidas = 0
+                logging.info("Circuito %s %s fechado após sonda bem-sucedida.", self.integracao, self.dominio)
+            # Chamadas iniciadas antes da abertura não fecham o circuito
+            return
+
+        self.contadores['falhas' if resultado == 'falha' else 'timeouts'] += 1
+        self.falhas_seguidas += 1
+        if self.estado == 'meio_aberto' or (self.estado == 'fechado' and self.falhas_seguidas >= CIRCUITO_FALHAS):
+            self.estado = 'aberto'
+            self.aberto_em = asyncio.get_running_loop().time()
+            self.contadores['aberturas'] += 1
+            logging.warning("Circuito %s %s aberto por %s segundos após %s falha(s) seguida(s).", self.integracao, self.dominio, CIRCUITO_ABERTO, self.falhas_seguidas)
+
+    def situacao(self):
+        """Estado e contadores do domínio."""
+        return {
+            'integracao': self.integracao,
+            'dominio': self.dominio,
+            'estado': self.estado,
+            'falhas_seguidas': self.falhas_seguidas,
+            'taxa': self.taxa,
+            'rajada': self.rajada,
+            'tokens': round(self.tokens, 2),
+            **self.contadores
+        }
+
+class ChamadaExterna:
+    """Contexto de uma chamada a um domínio: resposta HTTP 5xx, timeout e erro de conexão contam como falha."""
+
+    def __init__(self, controle):
+        self.controle = controle
+        self.sonda = False
+        self.resultado = 'sucesso'
+
+    def resposta(self, status):
+        """Classifica a resposta HTTP: 5xx é falha do domínio; 429 e demais erros não alteram o circuito."""
+        if status >= 500:
+            self.resultado = 'falha'
+        elif status == 429:
+            self.resultado = None
+
+    async def __aenter__(self):
+        await self.controle.entrar()
+        self.sonda = self.controle.estado == 'meio_aberto'
+        return self
+
+    async def __aexit__(self, tipo, erro, tb):
+        if tipo is None:
+            resultado = self.resultado
+        elif issubclass(tipo, asyncio.TimeoutError):
+            resultado = 'timeout'
+        elif issubclass(tipo, (aiohttp.ClientError, OSError)):
+            resultado = 'falha'
+        else:
+            resultado = None  # Cancelamento ou erro local (ex.: JSON inválido) não indica falha do domínio
+        self.controle.sair(self.sonda, resultado)
+        return False
+
+class ChamadasExternas:
+    """Controle (token bucket e circuit breaker) de cada domínio Gesthor e Omniplus chamado pelo processo."""
+
+    def __init__(self):
+        self.dominios = {}
+
+    def chamada(self, integracao, dominio):
+        """Contexto assíncrono de uma chamada ao domínio; levanta CircuitoAberto se o domínio estiver isolado."""
+        controle = self.dominios.get((integracao, dominio))
+        if controle is None:
+            cfg = {**CHAMADAS_EXTERNAS[integracao], **CHAMADAS_EXTERNAS_DOMINIOS.get(dominio, {})}
+            controle = ControleDominio(integracao, dominio, cfg['taxa'], cfg['rajada'])
+            self.dominios[(integracao, dominio)] = controle
+        return ChamadaExterna(controle)
+
+    def situacao(self):
+        """Estado e contadores de todos os domínios chamados."""
+        return [controle.situacao() for controle in self.dominios.values()]
+
+# Camada de chamadas externas compartilhada por fetch, send_data_to_omniplus e send_to_gesthor
+chamadas_externas = ChamadasExternas()
+
+class SnapshotClientes:
+    """Configuração imutável dos clientes (tb_cliente), indexada por domínio Gesthor, domínio Omniplus e token Gesthor."""
+
+    def __init__(self, rows, versao):
+        self.versao = versao
+        self.clientes = tuple(MappingProxyType(dict(row)) for row in rows)
+        self.ativos = tuple(cliente for cliente in self.clientes if cliente['ativo'] == 'sim')
+
+        por_dominio_omniplus = {}
+        por_token = {}
+        for cliente in self.clientes:
+            por_dominio_omniplus.setdefault(cliente['dominio_omniplus'], []).append(cliente)
+            por_token.setdefault(cliente['bearer_gesthor'], []).append(cliente)
+
+        self.por_dominio_gesthor = MappingProxyType({cliente['dominio_gesthor']: cliente for cliente in self.clientes})
+        self.por_dominio_omniplus = MappingProxyType({chave: tuple(lista) for chave, lista in por_dominio_omniplus.items()})
+        self.por_token = MappingProxyType({chave: tuple(lista) for chave, lista in por_token.items()})
+
+class ConfigClientes:
+    """Snapshot da configuração dos clientes compartilhado pelo processo, invalidado pela rota /parametros e por NOTIFY."""
+
+    def __init__(self):
+        self.snapshot = None
+        self.valido = False
+        self.versao = 0
+        self.ultima_recarga = 0.0
+        self.lock = None  # Criado no loop de eventos na primeira recarga
+
+    async def carregar(self, db):
+        """Lê tb_cliente e troca o snapshot inteiro de uma vez."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # Invalidações que chegarem durante a leitura provocam nova recarga
+            self.valido = True
+            try:
+                async with db.acquire() as connection:
+                    rows = await connection.fetch("""
+                        SELECT dominio_gesthor, cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus,
+                               hora_manha, hora_tarde, hora_noite, minuto_manha, minuto_tarde, minuto_noite,
+                               template_consulta, dias_consulta, template_exame, dias_exame,
+                               template_retorno, dias_retorno, template_cirurgia, dias_cirurgia, ativo
+                        FROM tb_cliente
+                        ORDER BY dominio_gesthor
+                    """)
+            except BaseException:
+                # Leitura falhou: o snapshot anterior continua em uso, mas é recarregado no próximo acesso
+                self.valido = False
+                raise
+            self.ultima_recarga = asyncio.get_running_loop().time()
+            # Mesma configuração: mantém o snapshot e a versão (o agendador só remonta a agenda quando a versão muda)
+            if self.snapshot is not None and self.snapshot.clientes == tuple(dict(row) for row in rows):
+                logging.debug("Configuração dos clientes sem alterações (versão %s).", self.versao)
+                return self.snapshot
+            self.versao += 1
+            self.snapshot = SnapshotClientes(rows, self.versao)
+            logging.debug("Configuração dos clientes carregada (versão %s): %s cliente(s).", self.versao, len(rows))
+            return self.snapshot
+
+    def invalidar(self, *args):
+        """Marca o snapshot para recarga no próximo uso (também usado como callback do NOTIFY)."""
+        self.valido = False
+
+    async def obter(self, db):
+        """Retorna o snapshot atual, recarregando se tiver sido invalidado."""
+        if self.snapshot is None or not self.valido:
+            return await self.carregar(db)
+        return self.snapshot
+
+    async def clientes_do_token(self, db, token):
+        """Retorna os clientes de um token Gesthor; um token desconhecido provoca no máximo uma recarga por intervalo."""
+        snapshot = await self.obter(db)
+        clientes = snapshot.por_token.get(token)
+        if clientes is None and asyncio.get_running_loop().time() - self.ultima_recarga >= CONFIG_CLIENTES_RECARGA_MINIMA:
+            # Token novo ou alterado por outro processo antes do NOTIFY
+            snapshot = await self.carregar(db)
+            clientes = snapshot.por_token.get(token)
+        return clientes or ()
+
+# Configuração dos clientes compartilhada pelo processo
+config_clientes = ConfigClientes()
+
+async def manter_config_clientes(app):
+    """Escuta o NOTIFY de alterações em tb_cliente e recarrega a configuração periodicamente."""
+    logging.debug("Escuta o NOTIFY de alterações em tb_cliente e recarrega a configuração periodicamente.")
+    conexao_notify = None
+    try:
+        while True:
+            if conexao_notify is None or conexao_notify.is_closed():
+                conexao_notify = await escutar_canal(CONFIG_CLIENTES_CANAL_NOTIFY, config_clientes.invalidar)
+                # Alterações feitas enquanto a escuta estava fora do ar
+                config_clientes.invalidar()
+            try:
+                await config_clientes.obter(app['db'])
+            except Exception as e:
+                logging.error("Erro ao recarregar a configuração dos clientes: %s", e)
+            await asyncio.sleep(CONFIG_CLIENTES_INTERVALO)
+            config_clientes.invalidar()
+    finally:
+        if conexao_notify is not None and not conexao_notify.is_closed():
+            await conexao_notify.close()
+
+# Períodos do dia e as colunas de hora e minuto de cada um em tb_cliente
+PERIODOS = (
+    ('manhã', 'hora_manha', 'minuto_manha'),
+    ('tarde', 'hora_tarde', 'minuto_tarde'),
+    ('noite', 'hora_noite', 'minuto_noite')
+)
+
+def deslocamento_cliente(dominio_gesthor):
+    """Deslocamento fixo (segundos) do início do cliente, distribuindo os clientes do mesmo horário."""
+    if AGENDADOR_ESPALHAMENTO <= 0:
+        return 0
+    return zlib.crc32(dominio_gesthor.encode()) % AGENDADOR_ESPALHAMENTO
+
+def horarios_cliente(cliente):
+    """Retorna [(periodo, hora, minuto)] do cliente; horários repetidos valem para o primeiro período."""
+    horarios = []
+    vistos = set()
+    for periodo, campo_hora, campo_minuto in PERIODOS:
+        hora = cliente[campo_hora]
+        minuto = cliente.get(campo_minuto) or 0
+        if hora is None:
+            continue
+        if not (0 <= hora <= 23 and 0 <= minuto <= 59):
+            logging.warning("Horário inválido %s:%s da %s para o domínio %s, ignorado.", hora, minuto, periodo, cliente['dominio_gesthor'])
+            continue
+        if (hora, minuto) in vistos:
+            continue
+        vistos.add((hora, minuto))
+        horarios.append((periodo, hora, minuto))
+    return horarios
+
+def execucao_anterior_e_proxima(hora, minuto, deslocamento, agora):
+    """Retorna o último horário agendado até agora e o próximo depois de agora."""
+    alvo = datetime.combine(agora.date(), time(hora, minuto)) + timedelta(seconds=deslocamento)
+    if alvo > agora:
+        return alvo - timedelta(days=1), alvo
+    return alvo, alvo + timedelta(days=1)
+
+def montar_agenda(snapshot, execucoes, agora):
+    """Monta o min-heap (momento, dominio_gesthor, periodo) das próximas execuções, recuperando horários perdidos."""
+    agenda = []
+    recuperacao = timedelta(seconds=AGENDADOR_RECUPERACAO)
+    for cliente in snapshot.ativos:
+        dominio_gesthor = cliente['dominio_gesthor']
+        deslocamento = deslocamento_cliente(dominio_gesthor)
+        for periodo, hora, minuto in horarios_cliente(cliente):
+            anterior, proxima = execucao_anterior_e_proxima(hora, minuto, deslocamento, agora)
+            ultima = execucoes.get((dominio_gesthor, periodo))
+            # Sem histórico não há o que recuperar; com histórico, executa agora o horário perdido recente
+            if ultima is not None and ultima < anterior and agora - anterior <= recuperacao:
+                logging.info("Recuperando a execução da %s de %s para o domínio: %s", periodo, anterior, dominio_gesthor)
+                agenda.append((anterior, dominio_gesthor, periodo))
+            else:
+                agenda.append((proxima, dominio_gesthor, periodo))
+    heapq.heapify(agenda)
+    return agenda
 
-async def verificar_tarefas(db):
-    """Verifica se é hora de executar as tarefas para cada cliente."""
-    logging.debug("Verifica se é hora de executar as tarefas para cada cliente.")
+async def carregar_execucoes(db):
+    """Lê a última execução agendada de cada cliente e período."""
+    async with db.acquire() as connection:
+        rows = await connection.fetch("SELECT dominio_gesthor, periodo, ultima_execucao FROM tb_execucao_cliente")
+    return {(row['dominio_gesthor'], row['periodo']): row['ultima_execucao'] for row in rows}
 
-    now = datetime.now()
-    hora_atual = now.hour
-    
+async def registrar_execucao(db, dominio_gesthor, periodo, momento):
+    """Grava a execução agendada concluída de um cliente e período."""
     async with db.acquire() as connection:
+        await connection.execute("""
+            INSERT INTO tb_execucao_cliente (dominio_gesthor, periodo, ultima_execucao)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (dominio_gesthor, periodo)
+            DO UPDATE SET ultima_execucao = GREATEST(tb_execucao_cliente.ultima_execucao, EXCLUDED.ultima_execucao)
+        """, dominio_gesthor, periodo, momento)
+
+async def executar_agendamento(db, semaforo, cliente, periodo, momento):
+    """Executa as tarefas agendadas de um cliente e registra a execução."""
+    dominio_gesthor = cliente['dominio_gesthor']
+    atraso = (datetime.now() - momento).total_seconds()
+
+    # Todos os logs da execução (e das tarefas criadas por ela) levam id_execucao e cliente
+    with campos_log(id_execucao=novo_id_log(), cliente=dominio_gesthor, periodo=periodo):
+        logging.info("Executando tarefas da %s para o domínio: %s (agendado para %s, atraso de %.1f segundos)", periodo, dominio_gesthor, momento, atraso)
+
+        await executar_tarefas_cliente(db, semaforo, cliente, periodo)
+
         try:
-            # Consulta a tabela tb_disparo para verificar os horários de cada domínio
-            query = """
-            SELECT dominio_gesthor, cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus, hora_manha, hora_tarde, hora_noite, template_consulta, dias_consulta, template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia, dias_cirurgia
-            FROM tb_cliente
-            WHERE ativo = 'sim'            
-            """
-            rows = await connection.fetch(query)
-            
-            for row in rows:
-                dominio_gesthor = row['dominio_gesthor']
-                cliente_id_gesthor = row['cliente_id_gesthor']
-                bearer_gesthor = row['bearer_gesthor']
-                dominio_omniplus = row['dominio_omniplus']
-                bearer_omniplus = row['bearer_omniplus']
-                canal_omniplus = row['canal_omniplus']
-                hora_manha = row['hora_manha']
-                hora_tarde = row['hora_tarde']
-                hora_noite = row['hora_noite']
-                template_consulta = row['template_consulta']
-                dias_consulta = row['dias_consulta']
-                template_exame = row['template_exame']
-                dias_exame = row['dias_exame']
-                template_retorno = row['template_retorno']
-                dias_retorno = row['dias_retorno']
-                template_cirurgia = row['template_cirurgia']
-                dias_cirurgia = row['dias_cirurgia']
-
-                # Verifica se a hora atual corresponde a um dos horários definidos
-                if hora_atual == hora_manha:
-                    logging.info(f"Executando tarefas da manhã para o domínio: {dominio_gesthor}")
-                    # Aqui você chamaria a função que executa as tarefas da manhã
-                    await executar_tarefas(connection, dominio_gesthor, 'manhã', cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus, template_consulta, dias_consulta, template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia, dias_cirurgia)
-
-                elif hora_atual == hora_tarde:
-                    logging.info(f"Executando tarefas da tarde para o domínio: {dominio_gesthor}")
-                    # Aqui você chamaria a função que executa as tarefas da tarde
-                    await executar_tarefas(connection, dominio_gesthor, 'tarde', cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus, template_consulta, dias_consulta, template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia, dias_cirurgia)
-
-                elif hora_atual == hora_noite:
-                    logging.info(f"Executando tarefas da noite para o domínio: {dominio_gesthor}")
-                    # Aqui você chamaria a função que executa as tarefas da noite
-                    await executar_tarefas(connection, dominio_gesthor, 'noite', cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus, template_consulta, dias_consulta, template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia, dias_cirurgia)
+            await registrar_execucao(db, dominio_gesthor, periodo, momento)
+        except Exception as e:
+            logging.error("Erro ao registrar a execução da %s para o domínio %s: %s", periodo, dominio_gesthor, e)
+
+async def executar_tarefas_cliente(db, semaforo, row, periodo):
+    """Executa as tarefas de um cliente com conexão própria e tempo limite."""
+    logging.debug("Executa as tarefas de um cliente com conexão própria e tempo limite.")
+    dominio_gesthor = row['dominio_gesthor']
 
+    async with semaforo:
+        inicio = perf_counter()
+        resultado = 'ok'
+        try:
+            async with db.acquire() as connection:
+                await asyncio.wait_for(
+                    executar_tarefas(connection, dominio_gesthor, periodo, row['cliente_id_gesthor'], row['bearer_gesthor'], row['dominio_omniplus'], row['bearer_omniplus'], row['canal_omniplus'], row['template_consulta'], row['dias_consulta'], row['template_exame'], row['dias_exame'], row['template_retorno'], row['dias_retorno'], row['template_cirurgia'], row['dias_cirurgia']),
+                    timeout=TIMEOUT_CLIENTE
+                )
+        except asyncio.TimeoutError:
+            resultado = 'timeout'
+            logging.error("Tempo limite de %s segundos excedido ao executar as tarefas para o domínio %s.", TIMEOUT_CLIENTE, dominio_gesthor)
         except Exception as e:
-            logging.error(f"Erro ao verificar as tarefas: {e}")
+            resultado = 'erro'
+            logging.error("Erro ao executar as tarefas para o domínio %s: %s", dominio_gesthor, e)
+        finally:
+            metricas_execucoes.observar(perf_counter() - inicio, periodo=periodo, resultado=resultado)
 
 # Headers da API
 headers_gesthor = lambda cliente_id_gesthor, bearer_gesthor: {
@@ -120,221 +888,579 @@ headers_gesthor = lambda cliente_id_gesthor, bearer_gesthor: {
     'Content-Type': 'application/json'
 }
 
+# Semáforos por domínio Gesthor, compartilhados por todas as tarefas do processo
+semaforos_gesthor = {}
+
+def obter_semaforo_gesthor(dominio_gesthor):
+    """Retorna o semáforo que limita as requisições simultâneas a um domínio Gesthor."""
+    semaforo = semaforos_gesthor.get(dominio_gesthor)
+    if semaforo is None:
+        semaforo = asyncio.Semaphore(GESTHOR_MAX_REQUISICOES_PARALELAS)
+        semaforos_gesthor[dominio_gesthor] = semaforo
+    return semaforo
+
+def tempo_espera_retry(response, tentativa):
+    """Calcula a espera antes de repetir uma requisição limitada pela API (Retry-After ou backoff), até GESTHOR_ESPERA_RETRY_MAX."""
+    espera = GESTHOR_ESPERA_RETRY * (2 ** (tentativa - 1))
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            espera = max(float(retry_after), 0)
+        except ValueError:
+            pass  # Retry-After em formato de data, usa o backoff padrão
+    return min(espera, GESTHOR_ESPERA_RETRY_MAX)
+
 # Função para realizar a requisição
-async def fetch(session, url, headers):
+def endpoint_gesthor(session, url, *args, **kwargs):
+    """Endpoint do gthWS chamado (ex.: paciente/getId, agendamento/getPeriod), usado como operação nas métricas."""
+    caminho = urlsplit(url).path
+    return caminho.split('/gthWS/', 1)[-1].strip('/') or 'gthWS'
+
+@medir_chamada('gesthor', endpoint_gesthor)
+async def fetch(session, url, headers, semaforo=None):
+    """Requisição GET ao gthWS; o semáforo do domínio é ocupado por tentativa, não durante a espera entre elas."""
     logging.debug("Função para realizar a requisição.")
-    async with session.get(url, headers=headers) as response:
-        if response.status == 200:
-            try:
-                data = await response.json()
-                return data
-            except Exception as e:
-                logging.error(f"Erro ao processar a resposta JSON da API: {e}")
-                return None
-        else:
-            logging.error(f"Erro ao conectar à API: status {response.status}")
+    dominio = urlsplit(url).netloc
+    for tentativa in range(1, GESTHOR_MAX_TENTATIVAS + 1):
+        try:
+            async with semaforo or nullcontext(), chamadas_externas.chamada('gesthor', dominio) as chamada:
+                async with session.get(url, headers=headers) as response:
+                    chamada.resposta(response.status)
+                    if response.status == 200:
+                        try:
+                            data = await response.json(loads=carregar_json)
+                            return data
+                        except Exception as e:
+                            logging.error("Erro ao processar a resposta JSON da API: %s", e)
+                            return None
+                    elif response.status in (429, 503) and tentativa < GESTHOR_MAX_TENTATIVAS:
+                        # API sobrecarregada, aguarda antes de tentar novamente
+                        espera = tempo_espera_retry(response, tentativa)
+                        logging.warning("API limitou a requisição (status %s), nova tentativa em %s segundos: %s", response.status, espera, url)
+                    else:
+                        logging.error("Erro ao conectar à API: status %s", response.status)
+                        return None
+        except CircuitoAberto:
+            # Domínio isolado: não repete a requisição nem registra um erro por chamada
+            logging.debug("Requisição recusada, circuito aberto: %s", url)
             return None
+        await asyncio.sleep(espera)
 
-async def insert_controle(connection, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, agenda):
-    """Insere os dados na tabela tb_controle."""
-    logging.debug("Insere os dados na tabela tb_controle.")
+def converter_data_horario(data, horario):
+    """Converte data (DD/MM/YYYY) e horario (HH:MMh) nas colunas data_agendamento e hora_agendamento."""
+    data_agendamento = datetime.strptime(data, '%d/%m/%Y').date()
+    hora_agendamento = None
+    for formato in ('%H:%M:%S', '%H:%M'):
+        try:
+            hora_agendamento = datetime.strptime(str(horario).rstrip('h'), formato).time()
+            break
+        except ValueError:
+            continue
+    return data_agendamento, hora_agendamento
+
+async def gravar_cache_pacientes(connection, dominio_gesthor, pendentes):
+    """Grava em tb_cache_paciente, em um único comando, os telefones consultados na API durante a execução."""
+    logging.debug("Grava em tb_cache_paciente, em um único comando, os telefones consultados na API durante a execução.")
+    # PACIENTE_ID não numérico não cabe em paciente_id (bigint) e fica apenas em memória
+    pendentes = {paciente_id: telefone for paciente_id, telefone in pendentes.items() if str(paciente_id).isdigit()}
+    if not pendentes:
+        return
+    await connection.execute("""
+        INSERT INTO tb_cache_paciente (dominio_gesthor, paciente_id, telefone, atualizado_em)
+        SELECT $1, paciente_id, telefone, now()
+        FROM unnest($2::bigint[], $3::text[]) AS p(paciente_id, telefone)
+        ON CONFLICT (dominio_gesthor, paciente_id)
+        DO UPDATE SET telefone = EXCLUDED.telefone, atualizado_em = EXCLUDED.atualizado_em
+    """, dominio_gesthor, [int(paciente_id) for paciente_id in pendentes], list(pendentes.values()))
+
+async def insert_controle_lote(connection, registros, dominio_gesthor=None, contatos_pendentes=None):
+    """Grava os agendamentos de um cliente em tb_controle e tb_log em uma única passagem.
+
+    Na mesma transação grava os telefones novos do cache de pacientes (contatos_pendentes).
+    Retorna a quantidade de agendamentos novos; os já existentes são ignorados.
+    """
+    logging.debug("Grava os agendamentos de um cliente em tb_controle e tb_log em uma única passagem.")
+    # Cada registro: (dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, agenda, data_agendamento, hora_agendamento)
+    if not registros and not contatos_pendentes:
+        return 0
     try:
-        # Verifica se já existe um registro com o mesmo codigo_agendamento e numero_contato
-        existing_record = await connection.fetchrow("""
-            SELECT 1 FROM tb_controle 
-            WHERE codigo_agendamento = $1 AND numero_contato = $2
-        """, int(codigo_agendamento), int(numero_contato))
-        
-        if existing_record:
-            logging.warning(f"Registro já existe para codigo_agendamento {codigo_agendamento} e numero_contato {numero_contato}.")
-            return False  # Ou algum outro tipo de feedback
-        
-        # Se não existir, insere o novo registro
-        await connection.execute("""
-            INSERT INTO tb_controle (dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, status, confirmacao, agenda)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, 0, 'nao', $10)
-        """, dominio_omniplus, int(numero_contato), int(codigo_paciente), nome_paciente, tipo_agendamento, int(codigo_agendamento), data, horario, url_origem, agenda)
-        
+        async with connection.transaction():
+            if contatos_pendentes:
+                await gravar_cache_pacientes(connection, dominio_gesthor, contatos_pendentes)
+            if not registros:
+                return 0
+
+            # Tabela temporária com os mesmos tipos de tb_controle, descartada no commit
+            await connection.execute("""
+                CREATE TEMP TABLE tmp_controle ON COMMIT DROP AS
+                SELECT dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, agenda, data_agendamento, hora_agendamento
+                FROM tb_controle WITH NO DATA
+            """)
+            await connection.copy_records_to_table(
+                'tmp_controle',
+                records=registros,
+                columns=['dominio_omniplus', 'numero_contato', 'codigo_paciente', 'nome_paciente', 'tipo_agendamento', 'codigo_agendamento', 'data', 'horario', 'url_origem', 'agenda', 'data_agendamento', 'hora_agendamento']
+            )
+
+            # Insere somente os novos e grava o log e o status atual apenas das linhas realmente inseridas
+            inseridos = await connection.fetchval(f"""
+                WITH novos AS (
+                    INSERT INTO tb_controle (dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, status, confirmacao, agenda, data_agendamento, hora_agendamento)
+                    SELECT DISTINCT ON (codigo_agendamento, numero_contato)
+                           dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, 0, 'nao', agenda, data_agendamento, hora_agendamento
+                    FROM tmp_controle
+                    ORDER BY codigo_agendamento, numero_contato
+                    ON CONFLICT (codigo_agendamento, numero_contato) DO NOTHING
+                    RETURNING dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, agenda
+                ), logs AS (
+                    INSERT INTO tb_log (time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda)
+                    SELECT now(), dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, 0, 'nao', agenda
+                    FROM novos
+                    RETURNING *
+                ), status_atual AS (
+                    {SQL_STATUS_ATUAL}
+                )
+                SELECT count(*) FROM logs
+            """)
+        return inseridos
     except Exception as e:
-        logging.error(f"Ocorreu um erro ao inserir na tabela tb_controle: {e}")
+        logging.error("Ocorreu um erro ao gravar o lote na tabela tb_controle: %s", e)
         raise
 
+# Atualização de tb_status_atual a partir das linhas gravadas em tb_log no mesmo comando (CTE "logs").
+# DISTINCT ON: um lote pode ter o mesmo agendamento para mais de um contato.
+SQL_STATUS_ATUAL = """
+    INSERT INTO tb_status_atual (codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda)
+    SELECT DISTINCT ON (codigo_agendamento)
+           codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda
+    FROM logs
+    ORDER BY codigo_agendamento, time DESC
+    ON CONFLICT (codigo_agendamento) DO UPDATE SET
+        time = EXCLUDED.time,
+        dominio_omniplus = EXCLUDED.dominio_omniplus,
+        numero_contato = EXCLUDED.numero_contato,
+        codigo_paciente = EXCLUDED.codigo_paciente,
+        nome_paciente = EXCLUDED.nome_paciente,
+        tipo_agendamento = EXCLUDED.tipo_agendamento,
+        status = EXCLUDED.status,
+        confirmacao = EXCLUDED.confirmacao,
+        agenda = EXCLUDED.agenda
+    WHERE tb_status_atual.time <= EXCLUDED.time
+"""
+
 async def insert_log(connection, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda):
-    """Insere os dados na tabela tb_log."""
-    logging.debug("Insere os dados na tabela tb_log.")
+    """Insere os dados na tabela tb_log e atualiza tb_status_atual."""
+    logging.debug("Insere os dados na tabela tb_log e atualiza tb_status_atual.")
     try:
-        await connection.execute("""
-        INSERT INTO tb_log (time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda)
-        VALUES (now(), $1, $2, $3, $4, $5, $6, $7, $8, $9)
+        await connection.execute(f"""
+        WITH logs AS (
+            INSERT INTO tb_log (time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda)
+            VALUES (now(), $1, $2, $3, $4, $5, $6, $7, $8, $9)
+            RETURNING *
+        )
+        {SQL_STATUS_ATUAL}
         """, dominio_omniplus, int(numero_contato), int(codigo_paciente), nome_paciente, tipo_agendamento, int(codigo_agendamento), status, confirmacao, agenda)
     except Exception as e:
-        logging.error(f"Ocorreu um erro ao inserir na tabela tb_log: {e}")
+        logging.error("Ocorreu um erro ao inserir na tabela tb_log: %s", e)
         raise
 
-# Função para buscar o número de contato do paciente via API
-async def buscar_contato_paciente(session, base_url, paciente_id, headers):
+async def reconstruir_status_atual(connection):
+    """Recria tb_status_atual a partir do último registro de cada agendamento em tb_log."""
+    logging.debug("Recria tb_status_atual a partir do último registro de cada agendamento em tb_log.")
+    async with connection.transaction():
+        # TRUNCATE bloqueia os gravadores até o commit, nenhuma atualização é perdida
+        await connection.execute("TRUNCATE tb_status_atual")
+        resultado = await connection.execute("""
+            INSERT INTO tb_status_atual (codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda)
+            SELECT DISTINCT ON (codigo_agendamento)
+                   codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda
+            FROM tb_log
+            ORDER BY codigo_agendamento, time DESC
+        """)
+    total = int(resultado.split()[-1])
+    logging.info("tb_status_atual reconstruída com %s agendamento(s).", total)
+    return total
+
+# Função para buscar o número de contato do paciente via API (duração registrada pelo fetch como paciente/getId)
+async def buscar_contato_paciente(session, base_url, paciente_id, headers, semaforo=None):
     """Busca o número de contato do paciente usando o PACIENTE_ID."""
-    logging.debug(f"Busca o número de contato do paciente usando o PACIENTE_ID.")
+    logging.debug("Busca o número de contato do paciente usando o PACIENTE_ID.")
     paciente_url = f"{base_url}/paciente/getId?ID={paciente_id}"
-    logging.debug(f"paciente_url ===> {paciente_url}")
+    logging.debug("paciente_url ===> %s", paciente_url)
     try:
-        async with session.get(paciente_url, headers=headers) as response:
-            if response.status == 200:
-                paciente_data = await response.json()
-                return paciente_data.get('TELEFONE', None)  # Retorna o número de telefone ou None se não encontrado
-            else:
-                logging.error(f"Erro ao buscar informações do paciente {paciente_id}. Status: {response.status}")
-                return None
+        paciente_data = await fetch(session, paciente_url, headers, semaforo)
+        if isinstance(paciente_data, dict):
+            return paciente_data.get('TELEFONE', None)  # Retorna o número de telefone ou None se não encontrado
+        logging.error("Erro ao buscar informações do paciente %s.", paciente_id)
+        return None
     except Exception as e:
-        logging.error(f"Erro ao conectar à API para buscar o contato do paciente {paciente_id}: {e}")
+        logging.error("Erro ao conectar à API para buscar o contato do paciente %s: %s", paciente_id, e)
         return None
 
+class CacheContatoPaciente:
+    """Cache LRU com validade (TTL) dos telefones dos pacientes, chave (dominio_gesthor, PACIENTE_ID)."""
+
+    def __init__(self, max_itens, ttl, persistente=False):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self.persistente = persistente
+        self.itens = OrderedDict()  # chave -> (telefone, expira_em)
+        self.pendentes = {}         # dominio_gesthor -> {paciente_id: telefone} a gravar em tb_cache_paciente
+        self.em_andamento = {}      # chave -> tarefa da requisição em andamento
+        self.hits = 0
+        self.carregados_banco = 0
+        self.misses = 0
+        self.compartilhadas = 0
+
+    def _ler_memoria(self, chave):
+        """Retorna o telefone em memória ou None se ausente ou expirado."""
+        item = self.itens.get(chave)
+        if item is None:
+            return None
+        telefone, expira_em = item
+        if expira_em <= asyncio.get_running_loop().time():
+            del self.itens[chave]
+            return None
+        self.itens.move_to_end(chave)
+        return telefone
+
+    def _gravar_memoria(self, chave, telefone, validade=None):
+        """Grava o telefone em memória, descartando os itens menos usados acima do limite."""
+        validade = self.ttl if validade is None else validade
+        self.itens[chave] = (telefone, asyncio.get_running_loop().time() + validade)
+        self.itens.move_to_end(chave)
+        while len(self.itens) > self.max_itens:
+            self.itens.popitem(last=False)
+
+    async def carregar_dominio(self, connection, dominio_gesthor):
+        """Carrega do banco os telefones ainda válidos de um domínio (uma consulta por execução, na conexão da execução)."""
+        if not self.persistente:
+            return
+        try:
+            rows = await connection.fetch("""
+                SELECT paciente_id, telefone, EXTRACT(EPOCH FROM now() - atualizado_em) AS idade
+                FROM tb_cache_paciente
+                WHERE dominio_gesthor = $1
+                  AND atualizado_em > now() - make_interval(secs => $2)
+            """, dominio_gesthor, float(self.ttl))
+            for row in rows:
+                self._gravar_memoria((dominio_gesthor, str(row['paciente_id'])), row['telefone'], self.ttl - float(row['idade']))
+            self.carregados_banco += len(rows)
+            logging.debug("Cache de pacientes carregado do banco para o domínio %s: %s registro(s).", dominio_gesthor, len(rows))
+        except Exception as e:
+            logging.error("Erro ao carregar o cache de pacientes do domínio %s: %s", dominio_gesthor, e)
+
+    def retirar_pendentes(self, dominio_gesthor):
+        """Retorna e limpa os telefones do domínio consultados na API e ainda não gravados no banco."""
+        return self.pendentes.pop(dominio_gesthor, {})
+
+    def devolver_pendentes(self, dominio_gesthor, pendentes):
+        """Devolve telefones cuja gravação falhou, para a próxima execução do domínio."""
+        if pendentes:
+            self.pendentes.setdefault(dominio_gesthor, {}).update(pendentes)
+
+    async def _carregar(self, chave, buscar):
+        """Consulta a API e grava o resultado no cache."""
+        self.misses += 1
+        telefone = await buscar()
+        # Somente telefones encontrados são guardados, falhas são consultadas novamente
+        if telefone:
+            self._gravar_memoria(chave, telefone)
+            if self.persistente:
+                # Gravados de uma vez ao final da execução (gravar_cache_pacientes)
+                self.pendentes.setdefault(chave[0], {})[chave[1]] = telefone
+        return telefone
+
+    async def obter(self, dominio_gesthor, paciente_id, buscar):
+        """Retorna o telefone do paciente, chamando buscar() somente em caso de miss.
+
+        Consultas simultâneas do mesmo paciente compartilham a mesma requisição.
+        """
+        chave = (dominio_gesthor, str(paciente_id))
+
+        telefone = self._ler_memoria(chave)
+        if telefone is not None:
+            self.hits += 1
+            return telefone
+
+        tarefa = self.em_andamento.get(chave)
+        if tarefa is not None:
+            self.compartilhadas += 1
+        else:
+            tarefa = asyncio.ensure_future(self._carregar(chave, buscar))
+            self.em_andamento[chave] = tarefa
+            tarefa.add_done_callback(lambda _: self.em_andamento.pop(chave, None))
+
+        # shield: o cancelamento de quem aguarda não cancela a requisição compartilhada
+        return await asyncio.shield(tarefa)
+
+    def estatisticas(self):
+        """Retorna os contadores do cache."""
+        consultas = self.hits + self.misses + self.compartilhadas
+        return {
+            "itens": len(self.itens),
+            "max_itens": self.max_itens,
+            "ttl": self.ttl,
+            "persistente": self.persistente,
+            "hits": self.hits,
+            "carregados_banco": self.carregados_banco,
+            "misses": self.misses,
+            "compartilhadas": self.compartilhadas,
+            "taxa_acerto": round((self.hits + self.compartilhadas) / consultas, 4) if consultas else 0.0
+        }
+
+# Cache compartilhado por todas as execuções do processo
+cache_contatos = CacheContatoPaciente(CACHE_PACIENTE_MAX_ITENS, CACHE_PACIENTE_TTL, CACHE_PACIENTE_PERSISTENTE)
+
 async def executar_tarefas(connection, dominio_gesthor, periodo, cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus, canal_omniplus, template_consulta, dias_consulta, template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia, dias_cirurgia):
     """Executa as tarefas de acordo com o domínio e o período."""
     logging.debug("Executa as tarefas de acordo com o domínio e o período.")
-    base_url = f"http://{dominio_gesthor}/gthWS"  # URL dinâmica
+    base_url = f"{GESTHOR_ESQUEMA}://{dominio_gesthor}/gthWS"  # URL dinâmica
     headers = headers_gesthor(cliente_id_gesthor, bearer_gesthor)
 
+    # Limita as requisições simultâneas ao domínio Gesthor
+    semaforo = obter_semaforo_gesthor(dominio_gesthor)
+
+    # Janela de datas de cada tipo de agendamento
+    hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    dias_por_tipo = {"C": dias_consulta, "E": dias_exame, "R": dias_retorno, "P": dias_cirurgia}
+
     try:
-        async with aiohttp.ClientSession() as session:
-            logging.debug(f"Buscar convênios.")
-            convenio_url = f"{base_url}/convenio/getAll"
-            convenios = await fetch(session, convenio_url, headers)
-
-            if isinstance(convenios, list) and len(convenios) > 0:
-                # Encontra o primeiro convênio válido e segue com o processo
-                convenio_id = convenios[0]['ID']
-                logging.debug(f"Primeiro convenio encontrado: {convenio_id}")
+        session = sessoes_http.obter('gesthor')
+
+        async def fetch_limitado(url):
+            return await fetch(session, url, headers, semaforo)
+
+        async def buscar_contato_limitado(codigo_paciente):
+            async def buscar():
+                return await buscar_contato_paciente(session, base_url, codigo_paciente, headers, semaforo)
+            # A API só é consultada quando o telefone não está no cache
+            return await cache_contatos.obter(dominio_gesthor, codigo_paciente, buscar)
+
+        async def processar_agenda(agenda_id):
+            """Busca os agendamentos de uma agenda e, em seguida, os contatos dos pacientes."""
+            logging.debug("Buscar agendamentos com o AGENDA_ID e intervalo de datas.")
+            data_ini = hoje.strftime('%Y-%m-%d')
+            data_fim = (hoje + timedelta(days=max(dias_por_tipo.values()))).strftime('%Y-%m-%d')
+            status = 'A'
+
+            agendamento_url = (f"{base_url}/agendamento/getPeriod"
+                                f"?AGENDA_ID={agenda_id}&DATA_INI={data_ini}&DATA_FIM={data_fim}&STATUS={status}")
+
+            logging.debug("agendamento_url ===> %s", agendamento_url)
+
+            agendamentos = await fetch_limitado(agendamento_url)
+
+            if not isinstance(agendamentos, list) or len(agendamentos) == 0:
+                logging.debug("Nenhum agendamento encontrado para a agenda ID %s.", agenda_id)
+                return []
+
+            selecionados = []
+            for agendamento in agendamentos:
+                tipo = agendamento.get('TIPO')
+                if tipo not in dias_por_tipo:
+                    continue  # Ignora se o tipo não for reconhecido
+
+                # Consulta, exame, retorno e cirurgia são lembrados com antecedência própria
+                data_tipo = hoje + timedelta(days=dias_por_tipo[tipo])
+
+                # String de data original
+                data_original = agendamento.get('DATA', 'N/A')
+
+                # Converter a string para o objeto datetime
+                data_formatada = datetime.strptime(data_original, "%Y-%m-%d")
+
+                # Verificar se a data do agendamento está dentro do intervalo
+                if data_formatada != data_tipo:
+                    logging.debug("Data do agendamento %s fora do intervalo %s - %s, pulando registro.", data_original, data_tipo, data_tipo)
+                    continue  # Pula para o próximo agendamento se estiver fora do intervalo
+
+                if agendamento.get('PACIENTE_ID', 'N/A') == 'N/A':
+                    continue # Ignora se não houver codigo paciente
+
+                selecionados.append((agendamento, data_formatada))
+
+            # Busca os contatos dos pacientes da agenda em paralelo, mantendo a ordem dos agendamentos
+            contatos = await asyncio.gather(*(buscar_contato_limitado(agendamento['PACIENTE_ID']) for agendamento, _ in selecionados))
+
+            return [(agenda_id, agendamento, data_formatada, numero_contato)
+                    for (agendamento, data_formatada), numero_contato in zip(selecionados, contatos)]
+
+        # Telefones já conhecidos do domínio (cache persistente)
+        await cache_contatos.carregar_dominio(connection, dominio_gesthor)
+
+        logging.debug("Buscar convênios.")
+        convenio_url = f"{base_url}/convenio/getAll"
+        convenios = await fetch_limitado(convenio_url)
+
+        if isinstance(convenios, list) and len(convenios) > 0:
+            # Encontra o primeiro convênio válido e segue com o processo
+            convenio_id = convenios[0]['ID']
+            logging.debug("Primeiro convenio encontrado: %s", convenio_id)
                     
-                logging.debug(f"Buscar agendas para o convênio.")
-                agenda_url = f"{base_url}/agenda/getAll?CONVENIO_ID={convenio_id}"
-                agendas = await fetch(session, agenda_url, headers)
-
-                if isinstance(agendas, list) and len(agendas) > 0:
-                    for agenda in agendas:
-                        agenda_id = agenda['ID']  
-
-                        # Deixar essa opção habilitada apenas se for fazer teste de validação
-                        if agenda_id != 33 and dominio_gesthor == 'hospitalolhos.gesthor.falehandix.com.br':
-                             continue  # Pula para a próxima iteração se o ID não for 33
-                        
-                        logging.debug(f"Buscar agendamentos com o AGENDA_ID e intervalo de datas.")
-                        data_ini = datetime.now().strftime('%Y-%m-%d')
-                        data_fim = (datetime.now() + timedelta(days=max(dias_consulta, dias_exame, dias_retorno, dias_cirurgia))).strftime('%Y-%m-%d')
-                        status = 'A'
-
-                        agendamento_url = (f"{base_url}/agendamento/getPeriod"
-                                            f"?AGENDA_ID={agenda_id}&DATA_INI={data_ini}&DATA_FIM={data_fim}&STATUS={status}")
-
-                        logging.debug(f"agendamento_url ===> {agendamento_url}")
-
-                        agendamentos = await fetch(session, agendamento_url, headers)
-                        
-                        if isinstance(agendamentos, list) and len(agendamentos) > 0:
-                            for agendamento in agendamentos:
-                                tipo = agendamento.get('TIPO')
-                                if tipo == "C":
-                                    # Ajustar data_ini e data_fim para consulta
-                                    data_ini = (datetime.now() + timedelta(days=dias_consulta)).strftime('%Y-%m-%d')
-                                    data_fim = (datetime.now() + timedelta(days=dias_consulta)).strftime('%Y-%m-%d')
-                                elif tipo == "E":
-                                    # Ajustar data_ini e data_fim para exame
-                                    data_ini = (datetime.now() + timedelta(days=dias_exame)).strftime('%Y-%m-%d')
-                                    data_fim = (datetime.now() + timedelta(days=dias_exame)).strftime('%Y-%m-%d')
-                                elif tipo == "R":
-                                    # Ajustar data_ini e data_fim para retorno
-                                    data_ini = (datetime.now() + timedelta(days=dias_retorno)).strftime('%Y-%m-%d')
-                                    data_fim = (datetime.now() + timedelta(days=dias_retorno)).strftime('%Y-%m-%d')
-                                elif tipo == "P":
-                                    # Ajustar data_ini e data_fim para cirurgia
-                                    data_ini = (datetime.now() + timedelta(days=dias_cirurgia)).strftime('%Y-%m-%d')
-                                    data_fim = (datetime.now() + timedelta(days=dias_cirurgia)).strftime('%Y-%m-%d')
-                                else:
-                                    continue  # Ignora se o tipo não for reconhecido
-                                
-                                # String de data original
-                                data_original = agendamento.get('DATA', 'N/A')
-
-                                # Converter a string para o objeto datetime
-                                data_formatada = datetime.strptime(data_original, "%Y-%m-%d")
-                                
-                                # Verificar se a data do agendamento está dentro do intervalo
-                                data_ini_dt = datetime.strptime(data_ini, "%Y-%m-%d")
-                                data_fim_dt = datetime.strptime(data_fim, "%Y-%m-%d")
-                                
-                                if not (data_ini_dt <= data_formatada <= data_fim_dt):
-                                    logging.debug(f"Data do agendamento {data_original} fora do intervalo {data_ini} - {data_fim}, pulando registro.")
-                                    continue  # Pula para o próximo agendamento se estiver fora do intervalo
-                                
-                                # Formatar a data para o novo formato
-                                data = data_formatada.strftime("%d/%m/%Y")
-
-                                codigo_paciente = agendamento.get('PACIENTE_ID', 'N/A')
-
-                                if codigo_paciente == 'N/A':
-                                    continue # Ignora se não houver codigo paciente
-                                
-                                numero_contato = await buscar_contato_paciente(session, base_url, codigo_paciente, headers)
-                                if numero_contato:
-                                    numero_contato = numero_contato.lstrip('+').replace(' ', '')
-                                else:
-                                    continue  # Ignora se não houver numero de contato
-
-                                if numero_contato == '':
-                                    continue  # Ignora se numero de contato for em branco
-
-                                nome_paciente = agendamento.get('PACIENTE', 'N/A')
-                                tipo_agendamento = agendamento.get('TIPO')
-                                codigo_agendamento = agendamento.get('AGD_ID', 'N/A')
-                                horario = f"{agendamento.get('HORA', 'N/A')}h"
-                                url_origem = dominio_gesthor
-                                
-                                # Log para verificação
-                                logging.debug(f"Agendamento TIPO: {tipo}, Data Inicial: {data_ini}, Data Final: {data_fim}")
-
-                                # Exibir os dados relevantes do agendamento (último laço)
-                                logging.debug("Dados do último laço:")
-                                logging.debug(f"Agendamento ID: {agendamento.get('AGD_ID', 'N/A')}")
-                                logging.debug(f"Data do Agendamento: {agendamento.get('DATA', 'N/A')}")
-                                logging.debug(f"Hora do Agendamento: {agendamento.get('HORA', 'N/A')}")
-                                logging.debug(f"Confirmado: {agendamento.get('CONFIRMADO', 'N/A')}")
-                                logging.debug(f"Tipo do Agendamento: {agendamento.get('TIPO', 'N/A')}")
-                                logging.debug(f"Status do Agendamento: {agendamento.get('STATUS', 'N/A')}")
-                                logging.debug(f"Paciente ID: {agendamento.get('PACIENTE_ID', 'N/A')}")
-                                logging.debug(f"Telefone Paciente: {numero_contato}")
-                                logging.debug(f"Paciente: {agendamento.get('PACIENTE', 'N/A')}")
-                                logging.debug(f"Local ID: {agendamento.get('LOCAL_ID', 'N/A')}")
-                                logging.debug(f"Nome do Local: {agendamento.get('LOCAL_NOME', 'N/A')}")
-                                logging.debug(f"Telefone do Local: {agendamento.get('LOCAL_TELEFONE', 'N/A')}")
-                                logging.debug(f"Endereço do Local: {agendamento.get('LOCAL_ENDERECO', 'N/A')}")
-                                logging.debug(f"Agenda ID: {agendamento.get('AGENDA_ID', 'N/A')}")
-                                logging.debug(f"Agenda Tipo: {agendamento.get('AGENDA_TIPO', 'N/A')}")
-                                logging.debug(f"Agenda Código: {agendamento.get('AGENDA_CODIGO', 'N/A')}")
-                                logging.debug(f"Agenda Descrição: {agendamento.get('AGENDA_DESCRICAO', 'N/A')}")
-                                logging.debug(f"Procedimento ID: {agendamento.get('PROCEDIMENTO_ID', 'N/A')}")
-                                logging.debug(f"Procedimento Nome: {agendamento.get('PROCEDIMENTO_NOME', 'N/A')}")
-                                logging.debug(f"Plano ID: {agendamento.get('PLANO_ID', 'N/A')}")
-                                logging.debug(f"Plano Nome: {agendamento.get('PLANO_NOME', 'N/A')}")
-                                logging.debug(f"Exame: {agendamento.get('EXAME', 'N/A')}")
-                                logging.debug("===========================================================================================")
-
-                                await insert_controle(connection, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, data, horario, url_origem, agenda_id)
-                                await insert_log(connection, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, 0, 'nao', agenda_id)
-
-                            else:
-                                logging.debug(f"Nenhuma agenda encontrada para o Convênio ID {convenio_id}.")
+            logging.debug("Buscar agendas para o convênio.")
+            agenda_url = f"{base_url}/agenda/getAll?CONVENIO_ID={convenio_id}"
+            agendas = await fetch_limitado(agenda_url)
+
+            if isinstance(agendas, list) and len(agendas) > 0:
+                agenda_ids = []
+                for agenda in agendas:
+                    agenda_id = agenda['ID']  
+
+                    # Deixar essa opção habilitada apenas se for fazer teste de validação
+                    if agenda_id != 33 and dominio_gesthor == 'hospitalolhos.gesthor.falehandix.com.br':
+                         continue  # Pula para a próxima iteração se o ID não for 33
+
+                    agenda_ids.append(agenda_id)
+
+                # Todas as agendas são buscadas em paralelo (limitadas pelo semáforo do domínio)
+                resultados = await asyncio.gather(*(processar_agenda(agenda_id) for agenda_id in agenda_ids), return_exceptions=True)
+
+                registros = []
+                for agenda_id, resultado in zip(agenda_ids, resultados):
+                    if isinstance(resultado, Exception):
+                        logging.error("Erro ao buscar os agendamentos da agenda %s do domínio %s: %s", agenda_id, dominio_gesthor, resultado)
+                        continue
+
+                    for agenda_id, agendamento, data_formatada, numero_contato in resultado:
+                        if numero_contato:
+                            numero_contato = numero_contato.lstrip('+').replace(' ', '')
+                        else:
+                            continue  # Ignora se não houver numero de contato
+
+                        if numero_contato == '':
+                            continue  # Ignora se numero de contato for em branco
+
+                        # Formatar a data para o novo formato
+                        data = data_formatada.strftime("%d/%m/%Y")
+
+                        tipo = agendamento.get('TIPO')
+                        codigo_paciente = agendamento.get('PACIENTE_ID', 'N/A')
+                        nome_paciente = agendamento.get('PACIENTE', 'N/A')
+                        tipo_agendamento = agendamento.get('TIPO')
+                        codigo_agendamento = agendamento.get('AGD_ID', 'N/A')
+                        horario = f"{agendamento.get('HORA', 'N/A')}h"
+                        url_origem = dominio_gesthor
+                            
+                        # Um evento estruturado por agendamento (montado só com DEBUG ativo)
+                        if logging.getLogger().isEnabledFor(logging.DEBUG):
+                            logging.debug("Agendamento selecionado %s", codigo_agendamento, extra={'evento': 'agendamento', 'dados': {
+                                'agd_id': codigo_agendamento, 'tipo': tipo, 'data': data, 'hora': agendamento.get('HORA'),
+                                'confirmado': agendamento.get('CONFIRMADO'), 'status': agendamento.get('STATUS'),
+                                'paciente_id': codigo_paciente, 'paciente': nome_paciente, 'telefone': numero_contato,
+                                'local_id': agendamento.get('LOCAL_ID'), 'local_nome': agendamento.get('LOCAL_NOME'),
+                                'agenda_id': agenda_id, 'agenda_codigo': agendamento.get('AGENDA_CODIGO'), 'agenda_descricao': agendamento.get('AGENDA_DESCRICAO'),
+                                'procedimento_id': agendamento.get('PROCEDIMENTO_ID'), 'procedimento_nome': agendamento.get('PROCEDIMENTO_NOME'),
+                                'plano_id': agendamento.get('PLANO_ID'), 'plano_nome': agendamento.get('PLANO_NOME'), 'exame': agendamento.get('EXAME')
+                            }})
+
+
+                        # Conversão por agendamento: um dado inválido descarta apenas a própria linha, não o lote do cliente
+                        try:
+                            data_agendamento, hora_agendamento = converter_data_horario(data, horario)
+                            registro = (dominio_omniplus, int(numero_contato), int(codigo_paciente), nome_paciente, tipo_agendamento, int(codigo_agendamento), data, horario, url_origem, agenda_id, data_agendamento, hora_agendamento)
+                        except (TypeError, ValueError) as e:
+                            logging.warning("Agendamento %s do domínio %s ignorado por dados inválidos (telefone %s, paciente %s): %s",
+                                            codigo_agendamento, dominio_gesthor, numero_contato, codigo_paciente, e)
+                            continue
+                        registros.append(registro)
+
+                # Gravação em lote de todos os agendamentos do cliente
+                contatos_pendentes = cache_contatos.retirar_pendentes(dominio_gesthor)
+                try:
+                    novos = await insert_controle_lote(connection, registros, dominio_gesthor, contatos_pendentes)
+                except Exception:
+                    cache_contatos.devolver_pendentes(dominio_gesthor, contatos_pendentes)
+                    raise
+                logging.info("Agendamentos gravados para o domínio %s: %s novo(s) de %s encontrado(s).", dominio_gesthor, novos, len(registros))
             else:
-                logging.debug("Nenhum convênio encontrado.")
+                logging.debug("Nenhuma agenda encontrada para o Convênio ID %s.", convenio_id)
+        else:
+            logging.debug("Nenhum convênio encontrado.")
 
-    except Exception as e:
-        logging.error(f"Erro ao executar as tarefas para o domínio {dominio_gesthor}: {e}")
+        logging.info("Cache de pacientes após o domínio %s: %s", dominio_gesthor, cache_contatos.estatisticas())
 
-async def update_status_to_sent(connection, record):
-    """Atualiza o status para 1 (enviado Omniplus)."""
-    logging.debug("Atualiza o status para 1 (enviado Omniplus).")
-    await connection.execute("UPDATE tb_controle SET status = 1 WHERE id = $1", record['id'])
-    await insert_log(connection, record['dominio_omniplus'], record['numero_contato'], record['codigo_paciente'], record['nome_paciente'], record['tipo_agendamento'], record['codigo_agendamento'], 1, 'nao', record['agenda'])
+    except Exception as e:
+        logging.error("Erro ao executar as tarefas para o domínio %s: %s", dominio_gesthor, e)
+
+async def insert_log_lote(connection, registros):
+    """Insere vários registros na tabela tb_log e atualiza tb_status_atual em um único comando."""
+    logging.debug("Insere vários registros na tabela tb_log e atualiza tb_status_atual em um único comando.")
+    # Cada registro: (dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda)
+    if not registros:
+        return
+    colunas = list(zip(*registros))
+    try:
+        await connection.execute(f"""
+        WITH logs AS (
+            INSERT INTO tb_log (time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, status, confirmacao, agenda)
+            SELECT now(), * FROM unnest($1::text[], $2::bigint[], $3::bigint[], $4::text[], $5::text[], $6::bigint[], $7::int[], $8::text[], $9::int[])
+            RETURNING *
+        )
+        {SQL_STATUS_ATUAL}
+        """, list(colunas[0]), [int(v) for v in colunas[1]], [int(v) for v in colunas[2]], list(colunas[3]), list(colunas[4]),
+             [int(v) for v in colunas[5]], [int(v) for v in colunas[6]], list(colunas[7]), [int(v) for v in colunas[8]])
+    except Exception as e:
+        logging.error("Ocorreu um erro ao inserir o lote na tabela tb_log: %s", e)
+        raise
 
+async def update_status_to_sent(connection, records, reservado_ate):
+    """Atualiza o status para 1 (enviado Omniplus) de um lote reservado e retorna os ids finalizados."""
+    logging.debug("Atualiza o status para 1 (enviado Omniplus) de um lote reservado e retorna os ids finalizados.")
+    async with connection.transaction():
+        # Só finaliza a própria reserva: se ela venceu e foi reservada de novo, o outro processo finaliza
+        rows = await connection.fetch("""
+            UPDATE tb_controle SET status = 1, reservado_ate = NULL
+            WHERE id = ANY($1::int[]) AND status = 4 AND reservado_ate = $2
+            RETURNING id
+        """, [record['id'] for record in records], reservado_ate)
+        finalizados = {row['id'] for row in rows}
+        if not finalizados:
+            # Todas as reservas vencidas e retomadas por outro processo: nada a registrar
+            return finalizados
+        await insert_log_lote(connection, [
+            (record['dominio_omniplus'], record['numero_contato'], record['codigo_paciente'], record['nome_paciente'], record['tipo_agendamento'], record['codigo_agendamento'], 1, 'nao', record['agenda'])
+            for record in records if record['id'] in finalizados
+        ])
+    return finalizados
+
+async def liberar_reserva_envio(connection, records, reservado_ate):
+    """Devolve à fila (status 0) os registros reservados que não foram enviados."""
+    logging.debug("Devolve à fila (status 0) os registros reservados que não foram enviados.")
+    await connection.execute("""
+        UPDATE tb_controle SET status = 0, reservado_ate = NULL
+        WHERE id = ANY($1::int[]) AND status = 4 AND reservado_ate = $2
+    """, [record['id'] for record in records], reservado_ate)
+
+# Semáforos por domínio Omniplus e por canal, compartilhados por todos os lotes
+semaforos_omniplus = {}
+semaforos_canal_omniplus = {}
+
+def obter_semaforos_omniplus(dominio_omniplus, canal_omniplus):
+    """Retorna os semáforos que limitam os envios simultâneos ao domínio e ao canal Omniplus."""
+    semaforo_dominio = semaforos_omniplus.get(dominio_omniplus)
+    if semaforo_dominio is None:
+        semaforo_dominio = asyncio.Semaphore(OMNIPLUS_MAX_ENVIOS_POR_DOMINIO)
+        semaforos_omniplus[dominio_omniplus] = semaforo_dominio
+
+    chave_canal = (dominio_omniplus, canal_omniplus)
+    semaforo_canal = semaforos_canal_omniplus.get(chave_canal)
+    if semaforo_canal is None:
+        semaforo_canal = asyncio.Semaphore(OMNIPLUS_MAX_ENVIOS_POR_CANAL)
+        semaforos_canal_omniplus[chave_canal] = semaforo_canal
+
+    return semaforo_dominio, semaforo_canal
+
+async def enviar_omniplus_limitado(record):
+    """Envia um registro ao Omniplus respeitando os limites por domínio e por canal."""
+    semaforo_dominio, semaforo_canal = obter_semaforos_omniplus(record['dominio_omniplus'], record['canal_omniplus'])
+    with campos_log(cliente=record['url_origem'], id_controle=record['id']):
+        # Sempre domínio e depois canal, na mesma ordem em todos os envios
+        async with semaforo_dominio:
+            async with semaforo_canal:
+                return await send_data_to_omniplus(record)
+
+@medir_chamada('omniplus', 'send_omniplus')
 async def send_data_to_omniplus(record):
     """Envia dados para a API Omniplus."""
     logging.debug("Envia dados para a API Omniplus.")
@@ -367,7 +1493,7 @@ async def send_data_to_omniplus(record):
 
     dominio = record.get('dominio_omniplus', '')
     if not dominio:
-        logging.error(f"Domínio está vazio para o registro ID: {record['id']}")
+        logging.error("Domínio está vazio para o registro ID: %s", record['id'])
         return False
 
     headers = {
@@ -375,73 +1501,279 @@ async def send_data_to_omniplus(record):
         'Authorization': f"Bearer {str(record['bearer_omniplus'])}"
     }
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(f"https://{str(dominio)}/api/v1/template/send", json=payload, headers=headers) as response:
+    try:
+        session = sessoes_http.obter('omniplus')
+        async with chamadas_externas.chamada('omniplus', str(dominio)) as chamada:
+            async with session.post(f"{OMNIPLUS_ESQUEMA}://{str(dominio)}/api/v1/template/send", data=serializar_json(payload), headers=headers) as response:
+                chamada.resposta(response.status)
                 response_text = await response.text()
                 if response.status == 200:
-                    logging.info(f"Dados enviados para o Omniplus com sucesso. ID do registro: {record['id']}. Resposta: {response_text}")
+                    logging.info("Dados enviados para o Omniplus com sucesso. ID do registro: %s. Resposta: %s", record['id'], response_text)
                     return True
                 else:
-                    logging.error(f"Erro ao enviar dados para o Omniplus. ID do registro: {record['id']}. Status: {response.status}. Resposta: {response_text}")
+                    logging.error("Erro ao enviar dados para o Omniplus. ID do registro: %s. Status: %s. Resposta: %s", record['id'], response.status, response_text)
                     return False
-        except Exception as e:
-            logging.error(f"Erro ao enviar dados para o Omniplus: {e}")
-            return False
+    except CircuitoAberto:
+        logging.debug("Envio ao Omniplus adiado, circuito aberto para %s. ID do registro: %s", dominio, record['id'])
+        return False
+    except Exception as e:
+        logging.error("Erro ao enviar dados para o Omniplus: %s", e)
+        return False
 
-async def fetch_records_to_send(connection):
-    """Busca registros com status 0, sem duplicatas de domínio e número com status 1."""
-    logging.debug("Busca registros com status 0, sem duplicatas de domínio e número com status 1.")
+async def reservar_registros_envio(connection, snapshot, limite, ignorar=()):
+    """Reserva (status 4, SKIP LOCKED) um lote de registros a enviar, sem duplicatas de domínio e número com status 1."""
+    logging.debug("Reserva (status 4, SKIP LOCKED) um lote de registros a enviar, sem duplicatas de domínio e número com status 1.")
+    # Status 0 ou reserva vencida; o contato não pode ter envio aguardando resposta nem em andamento.
+    # Somente clientes ativos; a configuração de envio vem do snapshot, sem JOIN com tb_cliente
     query = """
-    SELECT a.id, a.dominio_omniplus, a.numero_contato, a.codigo_paciente, a.nome_paciente, a.tipo_agendamento, a.codigo_agendamento, a.data, a.horario, a.url_origem, a.agenda, b.bearer_omniplus, b.canal_omniplus, b.template_consulta, b.template_exame, b.template_retorno, b.template_cirurgia
-    FROM tb_controle a
-    JOIN tb_cliente b ON a.url_origem = b.dominio_gesthor
-    WHERE a.status = 0
-    AND b.ativo = 'sim'
-    AND TO_DATE(a.data, 'DD/MM/YYYY') >= CURRENT_DATE
-    AND NOT EXISTS (
-        SELECT 1
-        FROM tb_controle AS c
-        WHERE c.numero_contato = a.numero_contato
-        AND c.dominio_omniplus = a.dominio_omniplus
-        AND TO_DATE(c.data, 'DD/MM/YYYY') >= CURRENT_DATE
-        AND c.status = 1
+    WITH lote AS (
+        SELECT a.id, a.status AS status_anterior
+        FROM tb_controle a
+        WHERE (a.status = 0 OR (a.status = 4 AND a.reservado_ate < now()))
+        AND a.url_origem = ANY($1::text[])
+        AND a.id <> ALL($4::int[])
+        AND a.data_agendamento >= CURRENT_DATE
+        AND NOT EXISTS (
+            SELECT 1
+            FROM tb_controle AS c
+            WHERE c.dominio_omniplus = a.dominio_omniplus
+            AND c.numero_contato = a.numero_contato
+            AND (c.status = 1 OR (c.status = 4 AND c.reservado_ate >= now()))
+            AND c.data_agendamento >= CURRENT_DATE
+        )
+        ORDER BY a.data_agendamento, a.id
+        LIMIT $2
+        FOR UPDATE OF a SKIP LOCKED
     )
+    UPDATE tb_controle t
+    SET status = 4, reservado_ate = now() + make_interval(secs => $3)
+    FROM lote
+    WHERE t.id = lote.id
+    RETURNING t.id, t.dominio_omniplus, t.numero_contato, t.codigo_paciente, t.nome_paciente, t.tipo_agendamento, t.codigo_agendamento,
+              t.data, t.horario, t.url_origem, t.agenda, t.reservado_ate, lote.status_anterior
     """
-    return await connection.fetch(query)
+    rows = await connection.fetch(query, [cliente['dominio_gesthor'] for cliente in snapshot.ativos], limite, float(FILA_RESERVA), list(ignorar))
+
+    recuperados = sum(1 for row in rows if row['status_anterior'] == 4)
+    if recuperados:
+        logging.warning("%s registro(s) com reserva de envio vencida voltaram a ser reservados.", recuperados)
+
+    records = []
+    for row in rows:
+        cliente = snapshot.por_dominio_gesthor[row['url_origem']]
+        record = dict(row)
+        for campo in ('bearer_omniplus', 'canal_omniplus', 'template_consulta', 'template_exame', 'template_retorno', 'template_cirurgia'):
+            record[campo] = cliente[campo]
+        records.append(record)
+    return records
+
+async def escutar_canal(canal, callback):
+    """Abre uma conexão dedicada que escuta o NOTIFY de um canal do Postgres."""
+    logging.debug("Abre uma conexão dedicada que escuta o NOTIFY de um canal do Postgres.")
+    try:
+        conexao = await asyncpg.connect(DATABASE_CONFIG['dsn'])
+        await conexao.add_listener(canal, callback)
+        logging.info("Escutando o canal %s.", canal)
+        return conexao
+    except Exception as e:
+        logging.error("Erro ao escutar o canal %s, seguindo por consulta periódica: %s", canal, e)
+        return None
+
+async def processar_fila_envio(app):
+    """Envia ao Omniplus, em lotes reservados, os registros disponíveis na fila e retorna a quantidade de falhas."""
+    logging.debug("Envia ao Omniplus, em lotes reservados, os registros disponíveis na fila e retorna a quantidade de falhas.")
+    falhas = 0
+    try:
+        total = 0
+        ignorar = []  # Falhas desta passagem só voltam a ser tentadas na próxima
+        while True:
+            # Reserva um lote por vez: outros processos reservam os lotes seguintes (SKIP LOCKED)
+            async with app['db'].acquire() as connection:
+                lote = await reservar_registros_envio(connection, await config_clientes.obter(app['db']), LOTE_ENVIO, ignorar)
+            if not lote:
+                break
+            reservado_ate = lote[0]['reservado_ate']
+
+            with campos_log(id_lote=novo_id_log()):
+                try:
+                    # Os envios do lote são simultâneos e o status é gravado uma vez por lote
+                    resultados = await asyncio.gather(*(enviar_omniplus_limitado(record) for record in lote), return_exceptions=True)
+                except asyncio.CancelledError:
+                    async with app['db'].acquire() as connection:
+                        await liberar_reserva_envio(connection, lote, reservado_ate)
+                    raise
+
+                enviados = []
+                nao_enviados = []
+                for record, resultado in zip(lote, resultados):
+                    if isinstance(resultado, Exception):
+                        logging.error("Erro ao enviar dados para o Omniplus. ID do registro: %s: %s", record['id'], resultado)
+                        nao_enviados.append(record)
+                    elif resultado:
+                        enviados.append(record)
+                    else:
+                        nao_enviados.append(record)
+
+                async with app['db'].acquire() as connection:
+                    if enviados:
+                        finalizados = await update_status_to_sent(connection, enviados, reservado_ate)
+                        if len(finalizados) < len(enviados):
+                            logging.warning("%s registro(s) enviados com a reserva já vencida; status gravado por outro processo.", len(enviados) - len(finalizados))
+                    if nao_enviados:
+                        await liberar_reserva_envio(connection, nao_enviados, reservado_ate)
+                        ignorar.extend(record['id'] for record in nao_enviados)
+
+                total += len(lote)
+                falhas += len(nao_enviados)
+                logging.info("Lote processado: %s de %s registro(s) enviados ao Omniplus.", len(enviados), len(lote))
+
+            if len(lote) < LOTE_ENVIO:
+                break
+
+        if total:
+            logging.info("Processamento da fila concluído.")
+    except Exception as e:
+        falhas += 1
+        logging.error("Erro ao processar a fila: %s", e)
+    return falhas
 
 async def process_queue(app):
     """Processa a fila de registros para enviar dados ao Omniplus."""
     logging.debug("Processa a fila de registros para enviar dados ao Omniplus.")
-    while True:
-        
-        # Tratar o middleware.log
-        await tratar_middleware_log()
-        
-        async with app['db'].acquire() as connection:
+    evento = asyncio.Event()
+    conexao_notify = None
+
+    try:
+        while True:
+            # Reabre a escuta se a conexão foi perdida
+            if FILA_ESCUTAR_NOTIFY and (conexao_notify is None or conexao_notify.is_closed()):
+                conexao_notify = await escutar_canal(FILA_CANAL_NOTIFY, lambda *args: evento.set())
+
+            # Notificações que chegarem durante o processamento acionam uma nova passagem
+            evento.clear()
+            falhas = await processar_fila_envio(app)
+
+            # Com NOTIFY ativo a consulta periódica é só uma segurança; falhas são tentadas no intervalo normal
+            escutando = conexao_notify is not None and not conexao_notify.is_closed()
+            intervalo = FILA_INTERVALO_FALLBACK if escutando and not falhas else FILA_INTERVALO
             try:
-                records = await fetch_records_to_send(connection)
-                logging.debug(f"Lendo o banco")
-                for record in records:
-                    success = await send_data_to_omniplus(record)
-                    if success:
-                        await update_status_to_sent(connection, record)
-                        logging.info("Processamento da fila concluído.")
-            except Exception as e:
-                logging.error(f"Erro ao processar a fila: {e}")
-        await asyncio.sleep(60)
+                await asyncio.wait_for(evento.wait(), timeout=intervalo)
+                await asyncio.sleep(FILA_AGRUPAMENTO)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if conexao_notify is not None and not conexao_notify.is_closed():
+            await conexao_notify.close()
+
+def inicio_do_mes(data_base, meses=0):
+    """Retorna o primeiro dia do mês de data_base deslocado em meses."""
+    indice = data_base.year * 12 + (data_base.month - 1) + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+async def criar_particoes_log(connection, meses_adiante):
+    """Cria as partições mensais de tb_log do mês corrente até meses_adiante."""
+    logging.debug("Cria as partições mensais de tb_log do mês corrente até meses_adiante.")
+    hoje = date.today()
+    criadas = 0
+    for meses in range(0, meses_adiante + 1):
+        inicio = inicio_do_mes(hoje, meses)
+        fim = inicio_do_mes(hoje, meses + 1)
+        nome = f"tb_log_p{inicio:%Y_%m}"
+        existe = await connection.fetchval("SELECT to_regclass($1) IS NOT NULL", nome)
+        if existe:
+            continue
+        await connection.execute(f"CREATE TABLE IF NOT EXISTS {nome} PARTITION OF tb_log FOR VALUES FROM ('{inicio}') TO ('{fim}')")
+        logging.info("Partição %s criada (%s a %s).", nome, inicio, fim)
+        criadas += 1
+    return criadas
+
+async def listar_particoes_log(connection):
+    """Lista as partições de tb_log com o limite superior de cada uma."""
+    rows = await connection.fetch("""
+        SELECT c.relname AS nome, pg_get_expr(c.relpartbound, c.oid) AS limites
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'tb_log'::regclass
+        ORDER BY c.relname
+    """)
+    particoes = []
+    for row in rows:
+        # Ex.: FOR VALUES FROM ('2025-01-01 00:00:00') TO ('2025-02-01 00:00:00')
+        limite = re.search(r"TO \('(\d{4}-\d{2}-\d{2})", row['limites'] or '')
+        if limite:
+            particoes.append((row['nome'], datetime.strptime(limite.group(1), '%Y-%m-%d').date()))
+    return particoes
+
+async def exportar_particao_log(connection, nome):
+    """Exporta uma partição de tb_log para CSV compactado (gzip) em LOG_RETENCAO_DIR."""
+    logging.debug("Exporta uma partição de tb_log para CSV compactado (gzip) em LOG_RETENCAO_DIR.")
+    await asyncio.to_thread(os.makedirs, LOG_RETENCAO_DIR, exist_ok=True)
+    destino = os.path.join(LOG_RETENCAO_DIR, f"{nome}.csv.gz")
+    temporario = destino + ".parcial"
+
+    arquivo = await asyncio.to_thread(gzip.open, temporario, 'wb')
+    try:
+        async def gravar(dados):
+            # A escrita do gzip roda fora do loop de eventos
+            await asyncio.to_thread(arquivo.write, dados)
+        await connection.copy_from_table(nome, output=gravar, format='csv', header=True)
+    finally:
+        await asyncio.to_thread(arquivo.close)
+
+    # Só fica com o nome final após a cópia completa
+    await asyncio.to_thread(os.replace, temporario, destino)
+    logging.info("Partição %s exportada para %s.", nome, destino)
+    return destino
+
+async def aplicar_retencao_log(connection, retencao_meses):
+    """Retira de tb_log as partições cujos dados são todos anteriores ao período de retenção."""
+    logging.debug("Retira de tb_log as partições cujos dados são todos anteriores ao período de retenção.")
+    limite = inicio_do_mes(date.today(), -retencao_meses)
+    retiradas = []
+    for nome, fim in await listar_particoes_log(connection):
+        if fim > limite:
+            continue
+        if LOG_RETENCAO_EXPORTAR:
+            await exportar_particao_log(connection, nome)
+        await connection.execute(f"ALTER TABLE tb_log DETACH PARTITION {nome}")
+        if LOG_RETENCAO_APAGAR:
+            await connection.execute(f"DROP TABLE {nome}")
+            logging.info("Partição %s (dados até %s) apagada.", nome, fim)
+        else:
+            logging.info("Partição %s (dados até %s) desanexada de tb_log.", nome, fim)
+        retiradas.append(nome)
+    return retiradas
+
+async def gerenciar_particoes_log(app):
+    """Cria as próximas partições de tb_log e aplica a retenção periodicamente."""
+    logging.debug("Cria as próximas partições de tb_log e aplica a retenção periodicamente.")
+    while True:
+        try:
+            async with app['db'].acquire() as connection:
+                await criar_particoes_log(connection, LOG_PARTICOES_ADIANTE)
+                if LOG_RETENCAO_MESES > 0:
+                    await aplicar_retencao_log(connection, LOG_RETENCAO_MESES)
+        except Exception as e:
+            logging.error("Erro ao gerenciar as partições de tb_log: %s", e)
+        await asyncio.sleep(LOG_PARTICOES_INTERVALO)
 
 async def start_background_tasks(app):
     """Inicia tarefas em segundo plano ao iniciar o servidor."""
     logging.debug("Inicia tarefas em segundo plano ao iniciar o servidor.")
-    app['queue_task'] = asyncio.create_task(process_queue(app))
-
-async def cleanup_background_tasks(app):
-    """Encerra tarefas em segundo plano ao parar o servidor."""
-    logging.debug("Encerra tarefas em segundo plano ao parar o servidor.")
-    app['queue_task'].cancel()
-    await app['queue_task']
+    app['config_task'] = asyncio.create_task(manter_config_clientes(app))
+    app['queue_task'] = asyncio.create_task(process_queue(app))  # SKIP LOCKED: roda em todos os processos
+    app['outbox_evento'] = asyncio.Event()
+    app['outbox_task'] = asyncio.create_task(processar_outbox_gesthor(app))  # SKIP LOCKED: roda em todos os processos
+
+async def encerrar_tarefa(tarefa):
+    """Cancela uma tarefa em segundo plano e aguarda o seu término."""
+    tarefa.cancel()
+    try:
+        await tarefa
+    except asyncio.CancelledError:
+        pass
 
+@medir_chamada('gesthor', 'send_gesthor')
 async def send_to_gesthor(record, confirma):
     """Envia os dados para a API Gesthor e lida com a confirmação."""
     logging.debug("Envia os dados para a API Gesthor e lida com a confirmação.")
@@ -451,7 +1783,7 @@ async def send_to_gesthor(record, confirma):
     dominio = record.get('dominio_gesthor', '')
 
     if not dominio:
-        logging.error(f"Domínio está vazio para o registro ID: {record['id']}")
+        logging.error("Domínio está vazio para o registro ID: %s", record['id'])
         return False
 
     headers = {
@@ -463,47 +1795,145 @@ async def send_to_gesthor(record, confirma):
     url_path = "confirm" if confirma.lower() == "sim" else "notConfirm"
 
     # Formatar a URL como no exemplo do Postman
-    url = f"http://{dominio}/gthWS/agendamento/{url_path}?PACIENTE_ID={paciente_id}&AGD_ID={agd_id}"
-
-    logging.debug(f"URL: {url}")
-    logging.debug(f"Headers: {headers}")
-    logging.debug(f"PACIENTE_ID  ==>> {record['codigo_paciente']}")
-    logging.debug(f"AGD_ID ==>> {record['codigo_agendamento']}")
-    logging.debug(f"dominio ==>> {dominio}")
-    logging.debug(f"Bearer gestor ==>> {record['bearer_gesthor']}")
-    logging.debug(f"CLIENT_ID ==>> {record['cliente_id_gesthor']}")
-    logging.debug(f"url_path ==>> {url_path}")
-
-    async with aiohttp.ClientSession() as session:
-        try:
+    url = f"{GESTHOR_ESQUEMA}://{dominio}/gthWS/agendamento/{url_path}?PACIENTE_ID={paciente_id}&AGD_ID={agd_id}"
+
+    logging.debug("Confirmação ao Gesthor %s", url, extra={'evento': 'confirmacao_gesthor', 'dados': {
+        'paciente_id': paciente_id, 'agd_id': agd_id, 'dominio': dominio, 'client_id': record['cliente_id_gesthor'], 'acao': url_path
+    }})
+
+    try:
+        session = sessoes_http.obter('gesthor')
+        async with chamadas_externas.chamada('gesthor', dominio) as chamada:
             async with session.post(url, headers=headers, data='') as response:
+                chamada.resposta(response.status)
                 response_text = await response.text()
                 if response.status == 200:
-                    logging.info(f"Dados enviados para o Gesthor com sucesso. ID do registro: {record['id']}. Resposta: {response_text}")
+                    logging.info("Dados enviados para o Gesthor com sucesso. ID do registro: %s. Resposta: %s", record['id'], response_text)
                     return True
-        except Exception as e:
-            logging.error(f"Erro ao enviar dados para o Gesthor: {e}")
-            return False
+                logging.error("Erro ao enviar dados para o Gesthor. ID do registro: %s. Status: %s. Resposta: %s", record['id'], response.status, response_text)
+                return False
+    except CircuitoAberto:
+        logging.debug("Envio ao Gesthor adiado, circuito aberto para %s. ID do registro: %s", dominio, record['id'])
+        return False
+    except Exception as e:
+        logging.error("Erro ao enviar dados para o Gesthor: %s", e)
+        return False
+
+async def reservar_outbox_gesthor(connection, limite):
+    """Reserva as confirmações prontas para envio (SKIP LOCKED)."""
+    return await connection.fetch("""
+        WITH lote AS (
+            SELECT id
+            FROM tb_outbox_gesthor
+            WHERE situacao = 'pendente'
+              AND proxima_tentativa <= now()
+            ORDER BY proxima_tentativa
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE tb_outbox_gesthor o
+        SET proxima_tentativa = now() + make_interval(secs => $2)
+        FROM lote
+        WHERE o.id = lote.id
+        RETURNING o.*
+    """, limite, float(GESTHOR_OUTBOX_RESERVA))
+
+async def enviar_confirmacao_gesthor(item, snapshot):
+    """Envia uma confirmação do outbox ao Gesthor, limitado pelo semáforo do domínio."""
+    cliente = snapshot.por_dominio_gesthor.get(item['dominio_gesthor'])
+    if cliente is None:
+        logging.error("Cliente %s não encontrado para a confirmação do outbox ID: %s", item['dominio_gesthor'], item['id'])
+        return False
+
+    record = {
+        'id': item['controle_id'],
+        'codigo_paciente': item['codigo_paciente'],
+        'codigo_agendamento': item['codigo_agendamento'],
+        'dominio_gesthor': item['dominio_gesthor'],
+        'cliente_id_gesthor': cliente['cliente_id_gesthor'],
+        'bearer_gesthor': cliente['bearer_gesthor']
+    }
+    with campos_log(cliente=item['dominio_gesthor'], id_outbox=item['id'], id_controle=item['controle_id']):
+        async with obter_semaforo_gesthor(item['dominio_gesthor']):
+            return await send_to_gesthor(record, item['confirmacao'])
+
+async def processar_lote_outbox(app):
+    """Envia um lote de confirmações do outbox ao Gesthor e retorna a quantidade reservada."""
+    logging.debug("Envia um lote de confirmações do outbox ao Gesthor e retorna a quantidade reservada.")
+    itens = []
+    try:
+        async with app['db'].acquire() as connection:
+            itens = await reservar_outbox_gesthor(connection, GESTHOR_OUTBOX_LOTE)
+        if itens:
+            snapshot = await config_clientes.obter(app['db'])
+            with campos_log(id_lote=novo_id_log()):
+                resultados = await asyncio.gather(*(enviar_confirmacao_gesthor(item, snapshot) for item in itens), return_exceptions=True)
+
+            enviados = [item for item, resultado in zip(itens, resultados) if resultado is True]
+            falhas = [item for item, resultado in zip(itens, resultados) if resultado is not True]
+
+            async with app['db'].acquire() as connection:
+                async with connection.transaction():
+                    if enviados:
+                        await connection.execute("""
+                            UPDATE tb_outbox_gesthor
+                            SET situacao = 'enviado', enviado_em = now(), tentativas = tentativas + 1, ultimo_erro = NULL
+                            WHERE id = ANY($1::bigint[])
+                        """, [item['id'] for item in enviados])
+                        # Status 3 (respondido ao Gesthor) em um único insert
+                        await insert_log_lote(connection, [
+                            (item['dominio_omniplus'], item['numero_contato'], item['codigo_paciente'], item['nome_paciente'], item['tipo_agendamento'], item['codigo_agendamento'], 3, item['confirmacao'], item['agenda'])
+                            for item in enviados
+                        ])
+                    if falhas:
+                        await connection.execute("""
+                            UPDATE tb_outbox_gesthor
+                            SET tentativas = tentativas + 1,
+                                ultimo_erro = 'Falha no envio ao Gesthor',
+                                proxima_tentativa = now() + make_interval(secs => LEAST($2 * power(2, tentativas), $3)),
+                                situacao = CASE WHEN tentativas + 1 >= $4 THEN 'falha' ELSE 'pendente' END
+                            WHERE id = ANY($1::bigint[])
+                        """, [item['id'] for item in falhas], float(GESTHOR_OUTBOX_BACKOFF), float(GESTHOR_OUTBOX_BACKOFF_MAX), GESTHOR_OUTBOX_MAX_TENTATIVAS)
+
+            logging.info("Outbox Gesthor: %s confirmação(ões) enviada(s), %s com falha.", len(enviados), len(falhas))
+    except Exception as e:
+        logging.error("Erro ao processar o outbox do Gesthor: %s", e)
+    return len(itens)
+
+async def processar_outbox_gesthor(app):
+    """Envia ao Gesthor as confirmações gravadas pelo handle_return, com novas tentativas e backoff exponencial."""
+    logging.debug("Envia ao Gesthor as confirmações gravadas pelo handle_return, com novas tentativas e backoff exponencial.")
+    evento = app['outbox_evento']
+    while True:
+        evento.clear()
+        quantidade = await processar_lote_outbox(app)
+
+        # Lote cheio: continua imediatamente; senão aguarda nova confirmação ou o intervalo
+        if quantidade < GESTHOR_OUTBOX_LOTE:
+            try:
+                await asyncio.wait_for(evento.wait(), timeout=GESTHOR_OUTBOX_INTERVALO)
+            except asyncio.TimeoutError:
+                pass
 
 async def handle_return(request):
-    """Processa a requisição de retorno e lida com o banco de dados e o Gesthor."""
-    logging.debug("Processa a requisição de retorno e lida com o banco de dados e o Gesthor.")
+    """Processa a requisição de retorno e enfileira a confirmação para o Gesthor."""
+    logging.debug("Processa a requisição de retorno e enfileira a confirmação para o Gesthor.")
 
     try:
         # Extrai dados do JSON recebido
-        data = await request.json()
+        data = await request.json(loads=carregar_json)
         numero = data.get('numero', '').lstrip('+')
         confirma = data.get('confirma')
         auth_header = request.headers.get('Authorization', '')
         token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
 
-        logging.debug(f"Requisição recebida - numero: {numero}, Confirmação: {confirma}")
-        logging.debug(f"Token: {token}")
+        logging.debug("Requisição recebida - numero: %s, Confirmação: %s", numero, confirma)
+        logging.debug("Token: %s", token)
 
         # Verificação básica de dados
         if not numero or not confirma or not token:
             logging.debug("Campos obrigatórios ausentes ou token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 400,
                 "message": "Missing required fields or invalid token."
@@ -513,58 +1943,66 @@ async def handle_return(request):
         async with request.app['db'].acquire() as connection:
             # Consulta para buscar o registro relevante
             logging.debug("Consulta para buscar o registro relevante.")
+            # Domínios do token pela configuração em memória, sem JOIN com tb_cliente
+            clientes = [cliente['dominio_gesthor'] for cliente in await config_clientes.clientes_do_token(request.app['db'], str(token))]
+
+            # Busca pelo índice parcial idx_controle_pendente_resposta (status = 1)
             query = """
-            SELECT a.id, a.dominio_omniplus, a.numero_contato, a.codigo_paciente, a.nome_paciente, a.tipo_agendamento, a.codigo_agendamento, a.agenda,
-                   b.dominio_gesthor, b.cliente_id_gesthor, b.bearer_gesthor
-            FROM tb_controle a
-            JOIN tb_cliente b ON a.url_origem = b.dominio_gesthor
-            WHERE a.numero_contato = $1
-              AND b.bearer_gesthor = $2
-              AND a.status = 1
+            SELECT id, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, agenda, url_origem
+            FROM tb_controle
+            WHERE numero_contato = $1
+              AND status = 1
+              AND url_origem = ANY($2::text[])
+            LIMIT 1
             """
-            record = await connection.fetchrow(query, int(numero), str(token))
+            record = await connection.fetchrow(query, int(numero), list(clientes)) if clientes else None
 
             # Verifica se o registro foi encontrado
             if not record:
                 logging.debug("Nenhum registro correspondente encontrado.")
-                return web.json_response({
+                return resposta_json({
                     "status": "error",
                     "code": 404,
                     "message": "No matching record found."
                 }, status=404)
 
-            # Atualiza o status do controle
-            update_query = "UPDATE tb_controle SET status = 2, confirmacao = $1 WHERE id = $2"
-            await connection.execute(update_query, confirma, record['id'])
-
-            # Insere o log
-            await insert_log(connection, record['dominio_gesthor'], int(record['numero_contato']), str(record['codigo_paciente']), 
-                             record['nome_paciente'], record['tipo_agendamento'], int(record['codigo_agendamento']), 2, confirma, int(record['agenda']))
-
-            # Envia os dados para o Gesthor
-            success = await send_to_gesthor(record, confirma)
-            logging.debug(f"Retorno da função em success: {success}")
+            # Status, log e confirmação pendente gravados juntos; o envio ao Gesthor fica com o worker
+            async with connection.transaction():
+                # Atualiza o status do controle (status = 1: outra resposta simultânea pode ter chegado antes)
+                update_query = "UPDATE tb_controle SET status = 2, confirmacao = $1 WHERE id = $2 AND status = 1"
+                atualizado = await connection.execute(update_query, confirma, record['id'])
+                if atualizado == 'UPDATE 0':
+                    logging.debug("Registro já respondido por outra requisição.")
+                    return resposta_json({
+                        "status": "error",
+                        "code": 404,
+                        "message": "No matching record found."
+                    }, status=404)
 
-            # Retorna resposta para o cliente, independentemente do sucesso
-            if success:
                 # Insere o log
-                await insert_log(connection, record['dominio_gesthor'], int(record['numero_contato']), str(record['codigo_paciente']), 
-                             record['nome_paciente'], record['tipo_agendamento'], int(record['codigo_agendamento']), 3, confirma, int(record['agenda']))
-                return web.json_response({
-                    "status": "success",
-                    "code": 200,
-                    "message": "Status updated and log inserted successfully. Data sent to Gesthor."
-                }, status=200)
-            else:
-                return web.json_response({
-                    "status": "error",
-                    "code": 500,
-                    "message": "Failed to send data to Gesthor."
-                }, status=500)
+                await insert_log(connection, record['dominio_omniplus'], int(record['numero_contato']), str(record['codigo_paciente']), 
+                                 record['nome_paciente'], record['tipo_agendamento'], int(record['codigo_agendamento']), 2, confirma, int(record['agenda']))
+
+                # Enfileira a confirmação para o Gesthor
+                await connection.execute("""
+                    INSERT INTO tb_outbox_gesthor (controle_id, dominio_gesthor, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, codigo_agendamento, agenda, confirmacao)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                """, record['id'], record['url_origem'], record['dominio_omniplus'], int(record['numero_contato']), int(record['codigo_paciente']),
+                     record['nome_paciente'], record['tipo_agendamento'], int(record['codigo_agendamento']), int(record['agenda']), confirma)
+
+        # Acorda o worker do outbox deste processo
+        if 'outbox_evento' in request.app:
+            request.app['outbox_evento'].set()
+
+        return resposta_json({
+            "status": "success",
+            "code": 202,
+            "message": "Status updated and log inserted successfully. Confirmation queued for Gesthor."
+        }, status=202)
 
     except Exception as e:
-        logging.error(f"Erro inesperado: {e}")
-        return web.json_response({
+        logging.error("Erro inesperado: %s", e)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Internal server error."
@@ -586,7 +2024,7 @@ async def login(request):
 
     try:
         # Extrai dados do JSON recebido
-        data = await request.json()
+        data = await request.json(loads=carregar_json)
         email = data.get('email', '')
         password = data.get('password')
         auth_header = request.headers.get('Authorization', '')
@@ -594,12 +2032,12 @@ async def login(request):
         # Verifica se o token está presente e no formato correto
         token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
 
-        logging.debug(f"Requisição recebida - email: {email}, Password: {password}")
+        logging.debug("Requisição recebida - email: %s, Password: %s", email, password)
 
         # Verificação básica de dados
         if not email or not password or not token:
             logging.debug("Campos obrigatórios ausentes ou token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 400,
                 "message": "Missing required fields or invalid token."
@@ -608,7 +2046,7 @@ async def login(request):
         # Verificação de token
         if token != TOKEN_BD:
             logging.debug("Token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 401,
                 "message": "Invalid token."
@@ -634,9 +2072,9 @@ async def login(request):
                     nome = user['nome']
                     nivel = user['nivel']
 
-                    logging.debug(f"Login bem-sucedido - ID: {user_id}, Nome: {nome}")
+                    logging.debug("Login bem-sucedido - ID: %s, Nome: %s", user_id, nome)
 
-                    return web.json_response({
+                    return resposta_json({
                         "status": "success",
                         "code": 200,
                         "message": "Login successfully.",
@@ -648,22 +2086,22 @@ async def login(request):
                     }, status=200)
                 else:
                     logging.debug("Nenhum registro correspondente encontrado.")
-                    return web.json_response({
+                    return resposta_json({
                         "status": "success",
                         "code": 404,
                         "message": "No matching record found.",
                     }, status=404)
         except Exception as db_error:
-            logging.error(f"Erro ao acessar o banco de dados: {db_error}")
-            return web.json_response({
+            logging.error("Erro ao acessar o banco de dados: %s", db_error)
+            return resposta_json({
                 "status": "error",
                 "code": 500,
                 "message": "Database error."
             }, status=500)
 
     except Exception as e:
-        logging.error(f"Erro inesperado: {e}")
-        return web.json_response({
+        logging.error("Erro inesperado: %s", e)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Internal server error."
@@ -693,7 +2131,7 @@ async def consultaClientes(request):
         # Verificação de token
         if token != TOKEN_BD:
             logging.debug("Token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 401,
                 "message": "Invalid token."
@@ -705,7 +2143,7 @@ async def consultaClientes(request):
 
             query = """
             SELECT dominio_gesthor, cliente_id_gesthor, bearer_gesthor, dominio_omniplus, bearer_omniplus,
-                   canal_omniplus, hora_manha, hora_tarde, hora_noite, template_consulta, dias_consulta,
+                   canal_omniplus, hora_manha, hora_tarde, hora_noite, minuto_manha, minuto_tarde, minuto_noite, template_consulta, dias_consulta,
                    template_exame, dias_exame, template_retorno, dias_retorno, template_cirurgia,
                    dias_cirurgia, ativo
             FROM tb_cliente
@@ -720,7 +2158,7 @@ async def consultaClientes(request):
                 # Transformar os resultados em uma lista de dicionários
                 response_data = [{key: result[key] for key in result.keys()} for result in results]
                 
-                return web.json_response({
+                return resposta_json({
                     "status": "success",
                     "code": 200,
                     "message": "Client parameters retrieved successfully.",
@@ -728,24 +2166,164 @@ async def consultaClientes(request):
                 }, status=200)
 
             logging.debug("Nenhum registro encontrado.")
-            return web.json_response({
+            return resposta_json({
                 "status": "success",
                 "code": 404,
                 "message": "No client parameters found.",
             }, status=404)
 
     except Exception as db_error:
-        logging.error(f"Erro inesperado: {db_error}")
-        return web.json_response({
+        logging.error("Erro inesperado: %s", db_error)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Internal server error."
         }, status=500)
 
+# Função de consulta do cache de pacientes
+async def consultaCache(request):
+    """Consulta os contadores do cache de contatos dos pacientes."""
+    logging.debug("Consulta os contadores do cache de contatos dos pacientes.")
+
+    # Suporte para requisições OPTIONS
+    if request.method == 'OPTIONS':
+        return web.Response(headers={
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+            'Access-Control-Max-Age': '86400'
+        })
+
+    # Obter o cabeçalho de autorização
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
+
+    # Verificação de token
+    if token != TOKEN_BD:
+        logging.debug("Token inválido.")
+        return resposta_json({
+            "status": "error",
+            "code": 401,
+            "message": "Invalid token."
+        }, status=401)
+
+    return resposta_json({
+        "status": "success",
+        "code": 200,
+        "data": cache_contatos.estatisticas()
+    }, status=200)
+
+async def consultaChamadas(request):
+    """Consulta o estado do circuito e os contadores das chamadas a cada domínio Gesthor e Omniplus."""
+    logging.debug("Consulta o estado do circuito e os contadores das chamadas a cada domínio Gesthor e Omniplus.")
+
+    # Suporte para requisições OPTIONS
+    if request.method == 'OPTIONS':
+        return web.Response(headers={
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+            'Access-Control-Max-Age': '86400'
+        })
+
+    # Obter o cabeçalho de autorização
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
+
+    # Verificação de token
+    if token != TOKEN_BD:
+        logging.debug("Token inválido.")
+        return resposta_json({
+            "status": "error",
+            "code": 401,
+            "message": "Invalid token."
+        }, status=401)
+
+    return resposta_json({
+        "status": "success",
+        "code": 200,
+        "data": {"pid": os.getpid(), "dominios": chamadas_externas.situacao()}
+    }, status=200)
+
+def codificar_cursor_logs(row):
+    """Gera o cursor da próxima página a partir do último registro retornado."""
+    posicao = [row['nome_paciente'] or '', row['time'].isoformat(), row['codigo_agendamento']]
+    return base64.urlsafe_b64encode(json.dumps(posicao).encode()).decode()
+
+def decodificar_cursor_logs(cursor):
+    """Converte o cursor recebido em (nome_paciente, time, codigo_agendamento)."""
+    nome_paciente, time_iso, codigo_agendamento = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return nome_paciente or '', datetime.fromisoformat(time_iso), int(codigo_agendamento)
+
+# Exportação do consultaLogs (format=ndjson|csv): tipo de conteúdo e extensão do arquivo
+FORMATOS_EXPORTACAO_LOGS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv')
+}
+
+async def exportar_logs(request, connection, query, query_params, formato):
+    """Envia o resultado do consultaLogs em NDJSON ou CSV, lido por cursor no servidor em blocos de LOGS_EXPORTACAO_LOTE linhas."""
+    logging.debug("Envia o resultado do consultaLogs em NDJSON ou CSV, lido por cursor no servidor em blocos de LOGS_EXPORTACAO_LOTE linhas.")
+    tipo, extensao = FORMATOS_EXPORTACAO_LOGS[formato]
+    response = web.StreamResponse(headers={
+        'Content-Type': f"{tipo}; charset=utf-8",
+        'Content-Disposition': f'attachment; filename="logs_{datetime.now():%Y%m%d_%H%M%S}.{extensao}"',
+        # Cabeçalhos dos middlewares, que não alteram uma resposta já iniciada
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        'X-Request-ID': contexto_log.get().get('id_requisicao', '')
+    })
+    response.enable_chunked_encoding()
+
+    # Cursor no servidor só existe dentro de uma transação; somente leitura, sem bloquear gravações
+    async with connection.transaction(readonly=True):
+        statement = await connection.prepare(query)
+        colunas = [atributo.name for atributo in statement.get_attributes() if atributo.name != 'time']  # time: apenas ordenação
+        await response.prepare(request)
+
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer, lineterminator='\n') if formato == 'csv' else None
+        bloco = bytearray()
+        if escritor:
+            escritor.writerow(colunas)
+        linhas = 0
+
+        async def enviar_bloco():
+            if escritor:
+                bloco.extend(buffer.getvalue().encode('utf-8'))
+                buffer.seek(0)
+                buffer.truncate()
+            if bloco:
+                await response.write(bytes(bloco))
+                bloco.clear()
+
+        try:
+            async for record in statement.cursor(*query_params, prefetch=LOGS_EXPORTACAO_LOTE):
+                if escritor:
+                    escritor.writerow([valor_json(record[coluna]) if isinstance(record[coluna], (datetime, date)) else record[coluna] for coluna in colunas])
+                else:
+                    bloco.extend(serializar_json({coluna: record[coluna] for coluna in colunas}))
+                    bloco.extend(b'\n')
+                linhas += 1
+                if linhas % LOGS_EXPORTACAO_LOTE == 0:
+                    await enviar_bloco()
+            await enviar_bloco()
+        except (asyncpg.exceptions.PostgresError, OSError) as e:
+            # Resposta já iniciada: derruba a conexão sem o bloco final, para o arquivo não parecer completo
+            logging.error("Exportação de logs (%s) interrompida após %s linhas: %s", formato, linhas, e)
+            if request.transport is not None:
+                request.transport.abort()
+            return response
+
+    await response.write_eof()
+    logging.info("Exportação de logs (%s) concluída: %s linhas.", formato, linhas)
+    return response
+
 # Função de consulta logs com parâmetros
 async def consultaLogs(request):
-    """Consulta logs com parâmetros de filtros."""
-    logging.debug("Consulta logs com parâmetros de filtros.")
+    """Consulta logs com parâmetros de filtros, paginada por cursor."""
+    logging.debug("Consulta logs com parâmetros de filtros, paginada por cursor.")
 
     # Suporte para requisições OPTIONS (CORS)
     if request.method == 'OPTIONS':
@@ -766,7 +2344,7 @@ async def consultaLogs(request):
         # Verificação de token
         if token != TOKEN_BD:
             logging.debug("Token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 401,
                 "message": "Invalid token."
@@ -780,7 +2358,26 @@ async def consultaLogs(request):
         agenda = params.get('agenda')
         numero_contato = params.get('numeroContato')
         nome_paciente = params.get('nomePaciente')
-        limit = int(params.get('limit', 100))
+        cursor = params.get('cursor')
+        limit = params.get('limit', '100')
+        formato = params.get('format', 'json')
+
+        if not limit.isdigit() or not 1 <= int(limit) <= LOGS_LIMITE_MAXIMO:
+            logging.error("Erro: limit '%s' inválido.", limit)
+            return resposta_json({
+                "status": "error",
+                "code": 400,
+                "message": f"Invalid limit. Must be an integer between 1 and {LOGS_LIMITE_MAXIMO}."
+            }, status=400)
+        limit = int(limit)
+
+        if formato != 'json' and formato not in FORMATOS_EXPORTACAO_LOGS:
+            logging.error("Erro: formato '%s' inválido.", formato)
+            return resposta_json({
+                "status": "error",
+                "code": 400,
+                "message": "Invalid format. Must be json, ndjson or csv."
+            }, status=400)
 
         # Converte as strings em datas (datetime.date)
         if data_inicio:
@@ -798,63 +2395,29 @@ async def consultaLogs(request):
             # Terminar no final do dia (23:59:59.999999)
             data_fim = datetime.combine(data_fim, time.max)
 
+        # Posição da página anterior (nome_paciente, time, codigo_agendamento)
+        if cursor:
+            try:
+                cursor = decodificar_cursor_logs(cursor)
+            except Exception:
+                logging.error("Erro: cursor '%s' inválido.", cursor)
+                return resposta_json({
+                    "status": "error",
+                    "code": 400,
+                    "message": "Invalid cursor."
+                }, status=400)
+
         # Conexão com o banco de dados
         async with request.app['db'].acquire() as connection:
             logging.debug(
                 "Consulta no banco de dados logs com parâmetros de filtros.")
 
-            # Montagem da query com parâmetros dinâmicos
-            query = """ WITH UltimosRegistros AS (
-                SELECT
-                    a.codigo_paciente,
-                    a.nome_paciente,
-                    CASE
-                        WHEN LENGTH(a.numero_contato::TEXT) = 13 AND a.numero_contato::TEXT LIKE '55%' THEN
-                            SUBSTRING(a.numero_contato::TEXT FROM 1 FOR 2) || ' ' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 3 FOR 2) || ' ' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 5 FOR 1) || '.' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 6 FOR 4) || '-' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 10 FOR 4)
-                        WHEN LENGTH(a.numero_contato::TEXT) = 12 AND a.numero_contato::TEXT LIKE '55%' THEN
-                            SUBSTRING(a.numero_contato::TEXT FROM 1 FOR 2) || ' ' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 3 FOR 2) || ' ' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 5 FOR 4) || '-' ||
-                            SUBSTRING(a.numero_contato::TEXT FROM 9 FOR 4)
-                        ELSE
-                            a.numero_contato::TEXT
-                    END AS numero_contato_formatado,
-                    a.agenda,
-                    a.codigo_agendamento,
-                    a.tipo_agendamento,
-                    CASE
-                        WHEN a.tipo_agendamento = 'C' THEN 'Consulta'
-                        WHEN a.tipo_agendamento = 'E' THEN 'Exame'
-                        WHEN a.tipo_agendamento = 'R' THEN 'Retorno'
-                        WHEN a.tipo_agendamento = 'P' THEN 'Cirurgia'
-                        ELSE '*'
-                    END AS descricao_tipo_agendamento,
-                    TO_CHAR(a.time, 'DD/MM/YYYY HH24:MI') || 'h' AS time_formatado,
-                    a.status,
-                    a.confirmacao,
-                    CASE
-                        WHEN a.status = '0' THEN 'A enviar'
-                        WHEN a.status = '1' THEN 'Enviado'
-                        WHEN a.status = '2' THEN 'Recebido'
-                        WHEN a.status = '3' THEN 'Respondido'
-                        ELSE '*'
-                    END AS descricao_status,
-                    a.time,
-                    ROW_NUMBER() OVER(PARTITION BY a.codigo_agendamento ORDER BY a.time DESC) as rn
-                FROM
-                    tb_log a
-                WHERE 1=1
-            """
             query_params = []  # Lista para armazenar os parâmetros da query
             where_clauses = [] # Lista para armazenar as cláusulas WHERE dinâmicas
 
             # Adiciona condições dinâmicas conforme os parâmetros recebidos
             if data_inicio:
-                where_clauses.append("a.time >= $1")
+                where_clauses.append(f"a.time >= ${len(query_params) + 1}")
                 query_params.append(data_inicio)
 
             if data_fim:
@@ -873,8 +2436,8 @@ async def consultaLogs(request):
                     query_params.append(agenda)
                 except ValueError:
                     logging.error(
-                        f"Erro: agenda '{agenda}' não é um número inteiro válido.")
-                    return web.json_response({
+                        "Erro: agenda '%s' não é um número inteiro válido.", agenda)
+                    return resposta_json({
                         "status": "error",
                         "code": 400,
                         "message": "Invalid agenda format. Must be an integer."
@@ -888,8 +2451,8 @@ async def consultaLogs(request):
                     query_params.append(numero_contato)
                 except ValueError:
                     logging.error(
-                        f"Erro: numero_contato '{numero_contato}' não é um número inteiro válido.")
-                    return web.json_response({
+                        "Erro: numero_contato '%s' não é um número inteiro válido.", numero_contato)
+                    return resposta_json({
                         "status": "error",
                         "code": 400,
                         "message": "Invalid numero_contato format. Must be an integer."
@@ -899,40 +2462,77 @@ async def consultaLogs(request):
                 where_clauses.append(f"a.nome_paciente ILIKE ${len(query_params) + 1}")
                 query_params.append(f"%{nome_paciente}%")
 
-            # Adiciona as cláusulas WHERE à query da CTE
-            if where_clauses:
-                query += " AND " + " AND ".join(where_clauses)
+            filtros = "".join(" AND " + clause for clause in where_clauses)
 
-            # Finaliza a query principal para selecionar os últimos registros
-            query += f"""
-            )
+            # Continua a partir da última linha da página anterior
+            filtro_cursor = ""
+            if cursor:
+                filtro_cursor = f" AND (COALESCE(a.nome_paciente, ''), a.time, a.codigo_agendamento) > (${len(query_params) + 1}, ${len(query_params) + 2}, ${len(query_params) + 3})"
+                query_params.extend(cursor)
+
+            # Montagem da query: status atual de cada agendamento (tb_status_atual),
+            # percorrido na ordem de idx_status_atual_cursor até o limite; nome nulo ordena como '' (a comparação de NULL excluiria a linha)
+            query = f"""
             SELECT
-                codigo_paciente,
-                nome_paciente,
-                numero_contato_formatado,
-                agenda,
-                codigo_agendamento,
-                tipo_agendamento,
-                descricao_tipo_agendamento,
-                time_formatado,
-                status,
-                confirmacao,
-                descricao_status
+                a.codigo_paciente,
+                a.nome_paciente,
+                CASE
+                    WHEN LENGTH(a.numero_contato::TEXT) = 13 AND a.numero_contato::TEXT LIKE '55%' THEN
+                        SUBSTRING(a.numero_contato::TEXT FROM 1 FOR 2) || ' ' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 3 FOR 2) || ' ' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 5 FOR 1) || '.' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 6 FOR 4) || '-' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 10 FOR 4)
+                    WHEN LENGTH(a.numero_contato::TEXT) = 12 AND a.numero_contato::TEXT LIKE '55%' THEN
+                        SUBSTRING(a.numero_contato::TEXT FROM 1 FOR 2) || ' ' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 3 FOR 2) || ' ' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 5 FOR 4) || '-' ||
+                        SUBSTRING(a.numero_contato::TEXT FROM 9 FOR 4)
+                    ELSE
+                        a.numero_contato::TEXT
+                END AS numero_contato_formatado,
+                a.agenda,
+                a.codigo_agendamento,
+                a.tipo_agendamento,
+                CASE
+                    WHEN a.tipo_agendamento = 'C' THEN 'Consulta'
+                    WHEN a.tipo_agendamento = 'E' THEN 'Exame'
+                    WHEN a.tipo_agendamento = 'R' THEN 'Retorno'
+                    WHEN a.tipo_agendamento = 'P' THEN 'Cirurgia'
+                    ELSE '*'
+                END AS descricao_tipo_agendamento,
+                TO_CHAR(a.time, 'DD/MM/YYYY HH24:MI') || 'h' AS time_formatado,
+                a.status,
+                a.confirmacao,
+                CASE
+                    WHEN a.status = '0' THEN 'A enviar'
+                    WHEN a.status = '1' THEN 'Enviado'
+                    WHEN a.status = '2' THEN 'Recebido'
+                    WHEN a.status = '3' THEN 'Respondido'
+                    ELSE '*'
+                END AS descricao_status,
+                a.time
             FROM
-                UltimosRegistros
-            WHERE
-                rn = 1
+                tb_status_atual a
+            WHERE 1=1{filtros}{filtro_cursor}
             ORDER BY
-                nome_paciente,
-                time,
-                codigo_agendamento ASC
-            LIMIT ${len(query_params) + 1}
+                COALESCE(a.nome_paciente, ''),
+                a.time,
+                a.codigo_agendamento ASC
             """
-            query_params.append(limit)
+
+            # Exportação: todas as linhas por cursor no servidor, sem limite
+            if formato in FORMATOS_EXPORTACAO_LOGS:
+                logging.debug("Query da exportação (%s): %s", formato, query)
+                return await exportar_logs(request, connection, query, query_params, formato)
+
+            # Uma linha a mais indica que existe próxima página
+            query += f"LIMIT ${len(query_params) + 1}"
+            query_params.append(limit + 1)
 
             # Função para formatar a query com os parâmetros reais (para depuração)
             def format_query_with_params(query, params):
-                for i, param in enumerate(params, start=1):
+                for i, param in reversed(list(enumerate(params, start=1))):
                     # Verifica se o parâmetro é uma string e coloca entre aspas simples
                     if isinstance(param, str):
                         param = f"'{param}'"
@@ -941,7 +2541,7 @@ async def consultaLogs(request):
 
             # Exibir a consulta formatada com os parâmetros reais
             formatted_query = format_query_with_params(query, query_params)
-            logging.debug(f"Query final para teste: {formatted_query}")
+            logging.debug("Query final para teste: %s", formatted_query)
 
             # Executar a consulta
             results = await connection.fetch(query, *query_params)
@@ -949,42 +2549,38 @@ async def consultaLogs(request):
             # Se o registro foi encontrado, extrai os dados
             if results:
                 logging.debug("Consulta realizada com sucesso.")
-                # Transformar os resultados em uma lista de dicionários, convertendo datetime para string
-                response_data = []
-                for result in results:
-                    row = {}
-                    for key, value in result.items():
-                        if isinstance(value, datetime):
-                            row[key] = value.isoformat()
-                        elif isinstance(value, Decimal):  # conversão do decimal
-                            row[key] = float(value)  # ou str(value)
-                        else:
-                            row[key] = value
-                    response_data.append(row)
+                next_cursor = None
+                if len(results) > limit:
+                    results = results[:limit]
+                    next_cursor = codificar_cursor_logs(results[-1])
+
+                # Tipos (datetime, Decimal) convertidos pelo serializar_json; time é usado apenas para o cursor
+                response_data = [{key: value for key, value in result.items() if key != 'time'} for result in results]
 
-                return web.json_response({
+                return resposta_json({
                     "status": "success",
                     "code": 200,
-                    "data": response_data
+                    "data": response_data,
+                    "next_cursor": next_cursor
                 }, status=200)
 
             logging.debug("Nenhum registro encontrado.")
-            return web.json_response({
+            return resposta_json({
                 "status": "success",
                 "code": 404,
                 "message": "No logs found."
             }, status=404)
 
     except asyncpg.exceptions.PostgresError as db_error:
-        logging.error(f"Erro de banco de dados: {db_error}")
-        return web.json_response({
+        logging.error("Erro de banco de dados: %s", db_error)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Erro de banco de dados."
         }, status=500)
     except Exception as e:
-        logging.error(f"Erro inesperado: {e}")
-        return web.json_response({
+        logging.error("Erro inesperado: %s", e)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Internal server error."
@@ -1006,13 +2602,16 @@ async def parametros(request):
 
     try:
         # Extrai dados do JSON recebido
-        data = await request.json()
+        data = await request.json(loads=carregar_json)
         dominio_gesthor = data.get('dominio_gesthor', '')
         cliente_id_gesthor = data.get('cliente_id_gesthor', '')
         token_gesthor = data.get('token_gesthor', '')
         hora_manha = int(data.get('hora_manha', '0'))
         hora_tarde = int(data.get('hora_tarde', '0'))
         hora_noite = int(data.get('hora_noite', '0'))
+        minuto_manha = int(data.get('minuto_manha', '0'))
+        minuto_tarde = int(data.get('minuto_tarde', '0'))
+        minuto_noite = int(data.get('minuto_noite', '0'))
         dominio_omniplus = data.get('dominio_omniplus', '')
         token_omniplus = data.get('token_omniplus', '')
         canal_omniplus = data.get('canal_omniplus', '')
@@ -1030,12 +2629,12 @@ async def parametros(request):
         # Verifica se o token está presente e no formato correto
         token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
 
-        logging.debug(f"Requisição de parametros recebida - dominio_gesthor: {dominio_gesthor}")
+        logging.debug("Requisição de parametros recebida - dominio_gesthor: %s", dominio_gesthor)
 
         # Verificação de token
         if token != TOKEN_BD:
             logging.debug("Token inválido.")
-            return web.json_response({
+            return resposta_json({
                 "status": "error",
                 "code": 401,
                 "message": "Invalid token."
@@ -1053,11 +2652,13 @@ async def parametros(request):
                     hora_manha, hora_tarde, hora_noite,
                     template_consulta, dias_consulta, template_exame,
                     dias_exame, template_retorno, dias_retorno,
-                    template_cirurgia, dias_cirurgia, ativo
+                    template_cirurgia, dias_cirurgia, ativo,
+                    minuto_manha, minuto_tarde, minuto_noite
                 )
                 VALUES (
                     $1, $2, $3, $4, $5, $6, $7, $8, $9,
-                    $10, $11, $12, $13, $14, $15, $16, $17, $18
+                    $10, $11, $12, $13, $14, $15, $16, $17, $18,
+                    $19, $20, $21
                 )
                 ON CONFLICT (dominio_gesthor)
                 DO UPDATE SET
@@ -1077,159 +2678,185 @@ async def parametros(request):
                     dias_retorno = EXCLUDED.dias_retorno,
                     template_cirurgia = EXCLUDED.template_cirurgia,
                     dias_cirurgia = EXCLUDED.dias_cirurgia,
-                    ativo = EXCLUDED.ativo;
+                    ativo = EXCLUDED.ativo,
+                    minuto_manha = EXCLUDED.minuto_manha,
+                    minuto_tarde = EXCLUDED.minuto_tarde,
+                    minuto_noite = EXCLUDED.minuto_noite;
                 """
                 success = await connection.execute(
                     query, dominio_gesthor, cliente_id_gesthor, token_gesthor,
                     dominio_omniplus, token_omniplus, canal_omniplus,
                     hora_manha, hora_tarde, hora_noite,
                     consulta, dias_consulta, exame, dias_exame,
-                    retorno, dias_retorno, cirurgia, dias_cirurgia, ativo
+                    retorno, dias_retorno, cirurgia, dias_cirurgia, ativo,
+                    minuto_manha, minuto_tarde, minuto_noite
                 )
 
                 # Se o registro foi encontrado, extrai os dados
                 if success:
                     
-                    logging.debug(f"Registro cadastrado ou atualizado com sucesso.")
+                    logging.debug("Registro cadastrado ou atualizado com sucesso.")
 
-                    return web.json_response({
+                    # Recarrega a configuração deste processo; os demais recebem o NOTIFY de tb_cliente
+                    await config_clientes.carregar(request.app['db'])
+
+                    return resposta_json({
                         "status": "success",
                         "code": 200,
                         "message": "Client parameters updated successfully."
                     }, status=200)
                 else:
                     logging.debug("Nenhum registro gravado.")
-                    return web.json_response({
+                    return resposta_json({
                         "status": "success",
                         "code": 404,
                         "message": "Failed to update client parameters.",
                     }, status=404)
         except Exception as db_error:
-            logging.error(f"Erro ao acessar o banco de dados: {db_error}")
-            return web.json_response({
+            logging.error("Erro ao acessar o banco de dados: %s", db_error)
+            return resposta_json({
                 "status": "error",
                 "code": 500,
                 "message": "Database error."
             }, status=500)
 
     except Exception as e:
-        logging.error(f"Erro inesperado: {e}")
-        return web.json_response({
+        logging.error("Erro inesperado: %s", e)
+        return resposta_json({
             "status": "error",
             "code": 500,
             "message": "Internal server error."
         }, status=500)
 
-async def tratar_middleware_log():
-    """Função que arquiva e apaga logs antigos."""
-    log_dir_base = os.path.abspath("/app/igo/")  # Diretório base onde está o middleware.log
-    log_dir = os.path.abspath("/app/igo/log/")  # Diretório de arquivamento middleware.log_aaaa-mm-dd
-    log_file = os.path.join(log_dir_base, "middleware.log")
-    log_archive_prefix = "middleware.log_"
-
-    # Verifica se os diretórios existem, e cria se não existirem
-    if not os.path.exists(log_dir_base):
-        os.makedirs(log_dir_base)
-        logging.info(f"Diretório base {log_dir_base} criado.")
-    
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-        logging.info(f"Diretório de arquivamento {log_dir} criado.")
-
-    # Verifica se é o horário desejado (ex: 23:59)
-    now = datetime.now()
-    if now.hour == 23 and now.minute == 59:  # Mude para o horário real
-        logging.info(f"Processo de arquivamento de log iniciado às {now.hour}:{now.minute}.")
+# Função principal do agendamento das tarefas dos clientes
+async def main_scheduler(app):
+    """Executa as tarefas de cada cliente no horário configurado, a partir de um min-heap de próximas execuções."""
+    logging.debug("Executa as tarefas de cada cliente no horário configurado, a partir de um min-heap de próximas execuções.")
+    db = app['db']
+    semaforo = asyncio.Semaphore(MAX_CLIENTES_PARALELOS)
+    agenda = []
+    versao = None
+    em_execucao = {}  # (dominio_gesthor, periodo) -> tarefa em andamento
+    lancadas = {}     # (dominio_gesthor, periodo) -> último horário lançado neste processo
 
-        # Verifica se o arquivo middleware.log existe antes de arquivar
-        if os.path.exists(log_file):
+    try:
+        while True:
+            # Remonta a agenda quando a configuração dos clientes muda
             try:
-                if os.path.getsize(log_file) > 0:
-                    # Arquiva o log atual com a data de hoje
-                    archive_name = log_archive_prefix + now.strftime('%Y-%m-%d')
-                    archive_file = os.path.join(log_dir, archive_name)
-                    
-                    # Realiza a cópia do arquivo de log de forma assíncrona
-                    async with aiofiles.open(log_file, mode='r') as log_f, aiofiles.open(archive_file, mode='w') as archive_f:
-                        async for line in log_f:
-                            await archive_f.write(line)
-                    logging.info(f"Arquivo de log arquivado como {archive_name}")
-                    
-                    # Limpa o conteúdo do middleware.log de forma assíncrona
-                    async with aiofiles.open(log_file, mode='w') as log_f:
-                        await log_f.write("")  # Isso irá limpar o arquivo
-                    logging.info("Arquivo middleware.log zerado.")
-                else:
-                    logging.warning(f"O arquivo {log_file} está vazio, arquivamento não realizado.")
-            
+                snapshot = await config_clientes.obter(db)
+                if snapshot.versao != versao:
+                    execucoes = await carregar_execucoes(db)
+                    # Execuções lançadas e ainda não registradas não devem ser recuperadas de novo
+                    for chave, momento in lancadas.items():
+                        if execucoes.get(chave) is None or execucoes[chave] < momento:
+                            execucoes[chave] = momento
+                    agenda = montar_agenda(snapshot, execucoes, datetime.now())
+                    versao = snapshot.versao
+                    if agenda:
+                        logging.info("Agenda montada com %s horário(s); próxima execução em %s para o domínio %s.", len(agenda), agenda[0][0], agenda[0][1])
             except Exception as e:
-                logging.error(f"Erro ao arquivar o log: {e}")
-        else:
-            logging.warning(f"O arquivo {log_file} não foi encontrado para arquivamento.")
+                logging.error("Erro ao montar a agenda dos clientes: %s", e)
+                await asyncio.sleep(AGENDADOR_VERIFICACAO)
+                continue
+
+            # Lança todos os horários vencidos e reagenda cada um para o dia seguinte
+            agora = datetime.now()
+            while agenda and agenda[0][0] <= agora:
+                momento, dominio_gesthor, periodo = heapq.heappop(agenda)
+                heapq.heappush(agenda, (momento + timedelta(days=1), dominio_gesthor, periodo))
+
+                chave = (dominio_gesthor, periodo)
+                cliente = snapshot.por_dominio_gesthor.get(dominio_gesthor)
+                if cliente is None:
+                    continue
+                if chave in em_execucao:
+                    logging.warning("Tarefas da %s para o domínio %s ainda em execução, horário de %s ignorado.", periodo, dominio_gesthor, momento)
+                    continue
+
+                lancadas[chave] = momento
+                tarefa = asyncio.create_task(executar_agendamento(db, semaforo, cliente, periodo, momento))
+                em_execucao[chave] = tarefa
+                tarefa.add_done_callback(lambda _, chave=chave: em_execucao.pop(chave, None))
+
+            # Dorme até o próximo horário (calculado do relógio a cada volta, sem acumular desvio),
+            # acordando periodicamente para perceber alterações dos clientes
+            espera = AGENDADOR_VERIFICACAO
+            if agenda:
+                espera = min(max((agenda[0][0] - datetime.now()).total_seconds(), 0), AGENDADOR_VERIFICACAO)
+            await asyncio.sleep(espera)
+    finally:
+        for tarefa in list(em_execucao.values()):
+            tarefa.cancel()
+        await asyncio.gather(*em_execucao.values(), return_exceptions=True)
 
-        # Apagar logs com mais de 30 dias
+# Tarefas exclusivas do processo líder: com vários processos, rodar em mais de um duplicaria mensagens
+TAREFAS_LIDER = (main_scheduler, gerenciar_particoes_log)
+
+async def disputar_lideranca(app):
+    """Disputa o advisory lock do líder e executa as tarefas exclusivas enquanto o detiver."""
+    logging.debug("Disputa o advisory lock do líder e executa as tarefas exclusivas enquanto o detiver.")
+    while True:
+        conexao = None
+        tarefas = []
         try:
-            logging.info("Verificando arquivos antigos para exclusão.")
-            thirty_days_ago = now - timedelta(days=30)
-            for filename in os.listdir(log_dir):
-                if filename.startswith(log_archive_prefix):
-                    file_date_str = filename[len(log_archive_prefix):]
-                    try:
-                        file_date = datetime.strptime(file_date_str, '%Y-%m-%d')
-                        if file_date < thirty_days_ago:
-                            os.remove(os.path.join(log_dir, filename))
-                            logging.info(f"Arquivo de log antigo {filename} apagado.")
-                    except ValueError:
-                        # Se a data no nome do arquivo não for válida, ignora o arquivo
-                        logging.warning(f"Arquivo de log com nome inválido ignorado: {filename}")
+            # O lock é da sessão: se a conexão cair, o Postgres o libera e outro processo assume
+            conexao = await asyncpg.connect(DATABASE_CONFIG['dsn'])
+            while not await conexao.fetchval("SELECT pg_try_advisory_lock($1)", LIDER_CHAVE):
+                await asyncio.sleep(LIDER_INTERVALO)
+
+            logging.info("Processo %s assumiu a liderança (agendador e manutenção de tb_log).", os.getpid())
+            app['lider'] = True
+            tarefas = [asyncio.create_task(tarefa(app)) for tarefa in TAREFAS_LIDER]
+
+            while True:
+                await asyncio.sleep(LIDER_INTERVALO)
+                await conexao.fetchval("SELECT 1", timeout=LIDER_INTERVALO)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logging.error(f"Erro ao verificar ou remover arquivos antigos: {e}")
-
-# Função principal que roda a cada hora cheia
-async def main_scheduler(app):
-    """Função que roda a cada hora cheia para verificar tarefas agendadas."""
-    logging.debug(f"Função que roda a cada hora cheia para verificar tarefas agendadas.")
-    try:
-        while True:
-            # Passa o app['db'] para verificar_tarefas
-            await verificar_tarefas(app['db'])
-
-            # Aguarda até a próxima hora cheia
-            now = datetime.now()
-            minutos_faltando = 60 - now.minute
-            segundos_faltando = 60 - now.second
-            tempo_espera = minutos_faltando * 60 + segundos_faltando
-            logging.info(f"Aguardando {tempo_espera} segundos até a próxima execução.")
-            await asyncio.sleep(tempo_espera)
-    except Exception as e:
-        logging.error(f"Erro no scheduler principal: {e}")
-    finally:
-        await close_db(app)
+            logging.error("Processo %s perdeu ou não obteve a liderança: %s", os.getpid(), e)
+        finally:
+            if app['lider']:
+                logging.info("Processo %s encerrando as tarefas do líder.", os.getpid())
+            app['lider'] = False
+            for tarefa in tarefas:
+                await encerrar_tarefa(tarefa)
+            if conexao is not None:
+                try:
+                    await asyncio.wait_for(conexao.close(), timeout=LIDER_INTERVALO)
+                except Exception:
+                    conexao.terminate()
+        await asyncio.sleep(LIDER_INTERVALO)
 
 async def start_scheduler(app):
-    """Inicia o scheduler que roda a cada hora cheia como uma tarefa de segundo plano."""
-    logging.debug(f"Inicia o scheduler que roda a cada hora cheia como uma tarefa de segundo plano.")
-    app['scheduler_task'] = asyncio.create_task(main_scheduler(app))
+    """Inicia a disputa de liderança; o processo líder executa o agendador."""
+    logging.debug("Inicia a disputa de liderança; o processo líder executa o agendador.")
+    app['lider'] = False
+    app['lider_task'] = asyncio.create_task(disputar_lideranca(app))
 
 async def stop_scheduler(app):
-    """Encerra o scheduler ao finalizar o aplicativo."""
-    logging.debug(f"Encerra o scheduler ao finalizar o aplicativo.")
-    app['scheduler_task'].cancel()
-    await app['scheduler_task']
+    """Encerra as tarefas do líder e libera o advisory lock ao finalizar o aplicativo."""
+    logging.debug("Encerra as tarefas do líder e libera o advisory lock ao finalizar o aplicativo.")
+    await encerrar_tarefa(app['lider_task'])
 
 async def cleanup_background_tasks(app):
     """Encerra as tarefas em segundo plano ao parar o servidor."""
-    logging.debug(f"Encerra as tarefas em segundo plano ao parar o servidor.")
+    logging.debug("Encerra as tarefas em segundo plano ao parar o servidor.")
     await stop_scheduler(app)
+    await encerrar_tarefa(app['queue_task'])
+    await encerrar_tarefa(app['config_task'])
+    await encerrar_tarefa(app['outbox_task'])
 
 async def init_app():
     """Inicialização do aplicativo web"""
-    logging.debug(f"Inicialização do aplicativo web.")
-    app = web.Application(middlewares=[cors_middleware])
+    logging.debug("Inicialização do aplicativo web.")
+    app = web.Application(middlewares=[id_requisicao_middleware, metricas_middleware, cors_middleware])
 
     # Inicialização do banco de dados
     app.on_startup.append(init_db)
-    app.on_cleanup.append(close_db)
+
+    # Sessões HTTP compartilhadas (Gesthor / Omniplus)
+    app.on_startup.append(iniciar_sessoes_http)
 
     # Adiciona rotas
     app.router.add_post('/api/v1/template/return', handle_return)   # Rota para retorno da confirmação ou não do Omniplus interação do usuário.
@@ -1237,15 +2864,76 @@ async def init_app():
     app.router.add_post('/parametros', parametros)                  # Rota para gravação/alteração paramentors aplicação web.
     app.router.add_get('/consultaClientes', consultaClientes)       # Rota para consulta de clientes/dominios aplicação web.
     app.router.add_get('/consultaLogs', consultaLogs)               # Rota para consulta de log´s da aplicação na aplicação web.
+    app.router.add_get('/consultaCache', consultaCache)             # Rota para consulta dos contadores do cache de pacientes.
+    app.router.add_get('/consultaChamadas', consultaChamadas)       # Rota para consulta do circuit breaker e dos contadores por domínio.
+    app.router.add_get('/metrics', metrics)                         # Rota das métricas no formato texto do Prometheus.
 
     # Inicia o scheduler de tarefas
-    app.on_startup.append(start_scheduler)          # Inicia o scheduler que roda a cada hora cheia responsável por buscar as agendas do Gesthor em uma tarefa de segundo plano.
+    app.on_startup.append(start_scheduler)          # Disputa a liderança; o líder executa o agendador (agendas do Gesthor no horário de cada cliente).
     app.on_startup.append(start_background_tasks)   # Inicia tarefas em segundo plano/filas ao iniciar o servidor responsavél pelo envio dos templates ao contato.
     app.on_cleanup.append(cleanup_background_tasks) # Encerra tarefas em segundo plano ao parar o servidor.
+    app.on_cleanup.append(fechar_sessoes_http)      # Fecha as sessões HTTP após o encerramento das tarefas.
+    app.on_cleanup.append(close_db)                 # Por último: pool.close() aguarda as conexões em uso pelas tarefas já encerradas.
 
     return app
 
+async def comando_reconstruir_status():
+    """Comando de linha: recria tb_status_atual a partir de tb_log."""
+    connection = await asyncpg.connect(DATABASE_CONFIG['dsn'])
+    try:
+        total = await reconstruir_status_atual(connection)
+        print(f"tb_status_atual reconstruída com {total} agendamento(s).")
+    finally:
+        await connection.close()
+
+def executar_servidor(host, porta, reuse_port, worker=None):
+    """Executa o servidor web em um processo."""
+    global worker_atual
+    if worker is not None:
+        worker_atual = worker
+        # Cada worker grava e rotaciona o seu próprio arquivo (middleware-1.log, middleware-2.log, ...)
+        nome, extensao = os.path.splitext(LOG_FILE)
+        configurar_log(f"{nome}-{worker}{extensao}")
+    web.run_app(init_app(), host=host, port=porta, reuse_port=reuse_port)
+
+def supervisionar_workers(host, porta, quantidade):
+    """Inicia os processos do servidor na mesma porta (SO_REUSEPORT) e recria os que terminarem."""
+    def iniciar(worker):
+        processo = multiprocessing.Process(target=executar_servidor, args=(host, porta, True, worker), daemon=True)
+        processo.start()
+        logging.info("Worker %s iniciado.", processo.pid)
+        return processo
+
+    processos = [iniciar(worker) for worker in range(1, quantidade + 1)]
+    try:
+        while True:
+            for indice, processo in enumerate(processos):
+                processo.join(timeout=1)
+                if not processo.is_alive():
+                    logging.error("Worker %s terminou com código %s, reiniciando.", processo.pid, processo.exitcode)
+                    processos[indice] = iniciar(indice + 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for processo in processos:
+            processo.terminate()
+        for processo in processos:
+            processo.join()
+
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    web.run_app(init_app(), host='0.0.0.0', port=8080)
-    
+    parser = argparse.ArgumentParser(description="Middleware Handix")
+    parser.add_argument('comando', nargs='?', default='servidor', choices=['servidor', 'reconstruir-status'],
+                        help="servidor (padrão) ou reconstruir-status para recriar tb_status_atual a partir de tb_log")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="processos do servidor na mesma porta; agendador e partições de tb_log rodam apenas no líder, fila de envio e outbox em todos (padrão: config.WORKERS)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--porta', type=int, default=8080)
+    args = parser.parse_args()
+
+    if args.comando == 'reconstruir-status':
+        asyncio.run(comando_reconstruir_status())
+    else:
+        if args.workers > 1:
+            supervisionar_workers(args.host, args.porta, args.workers)
+        else:
+            executar_servidor(args.host, args.porta, False)
@@ -0,0 +1,15 @@
+-- Handix
+-- Cache persistente dos telefones dos pacientes (buscar_contato_paciente)
+-- Usado quando CACHE_PACIENTE_PERSISTENTE = True no config.py
+
+CREATE TABLE IF NOT EXISTS tb_cache_paciente (
+    dominio_gesthor TEXT NOT NULL,
+    paciente_id     BIGINT NOT NULL,
+    telefone        TEXT NOT NULL,
+    atualizado_em   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (dominio_gesthor, paciente_id)
+);
+
+-- Carga do cache por domínio somente das entradas dentro do TTL
+CREATE INDEX IF NOT EXISTS idx_cache_paciente_atualizado
+    ON tb_cache_paciente (dominio_gesthor, atualizado_em);
@@ -0,0 +1,13 @@
+-- Handix
+-- Chave única de tb_controle usada pela gravação em lote (INSERT ... ON CONFLICT)
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 002_tb_controle_unico.sql
+
+-- Remove duplicados gerados por execuções concorrentes, mantendo o registro mais antigo
+DELETE FROM tb_controle a
+USING tb_controle b
+WHERE a.codigo_agendamento = b.codigo_agendamento
+  AND a.numero_contato = b.numero_contato
+  AND a.id > b.id;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_controle_agendamento_contato
+    ON tb_controle (codigo_agendamento, numero_contato);
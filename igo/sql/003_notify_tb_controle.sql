@@ -0,0 +1,35 @@
+-- Handix
+-- Notifica o dispatcher (process_queue) quando há registros a enviar em tb_controle
+-- O canal deve ser o mesmo de FILA_CANAL_NOTIFY no config.py
+
+-- Novos registros com status 0 (uma notificação por comando, inclusive na gravação em lote)
+CREATE OR REPLACE FUNCTION fn_notificar_fila_insert() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM novos WHERE status = 0) THEN
+        PERFORM pg_notify('tb_controle_fila', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tg_notificar_fila_insert ON tb_controle;
+CREATE TRIGGER tg_notificar_fila_insert
+    AFTER INSERT ON tb_controle
+    REFERENCING NEW TABLE AS novos
+    FOR EACH STATEMENT EXECUTE FUNCTION fn_notificar_fila_insert();
+
+-- Resposta do paciente (status 1 -> 2) libera os demais registros do mesmo número
+-- O Postgres agrupa notificações iguais da mesma transação em uma só
+CREATE OR REPLACE FUNCTION fn_notificar_fila_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('tb_controle_fila', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tg_notificar_fila_update ON tb_controle;
+CREATE TRIGGER tg_notificar_fila_update
+    AFTER UPDATE OF status ON tb_controle
+    FOR EACH ROW
+    WHEN (OLD.status = 1 AND NEW.status <> 1)
+    EXECUTE FUNCTION fn_notificar_fila_update();
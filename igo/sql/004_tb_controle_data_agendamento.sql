@@ -0,0 +1,27 @@
+-- Handix
+-- Colunas de data/hora reais em tb_controle para a consulta da fila (fetch_records_to_send)
+-- data (DD/MM/YYYY) e horario (HH:MMh) continuam sendo gravados para o template do Omniplus
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 004_tb_controle_data_agendamento.sql
+
+ALTER TABLE tb_controle ADD COLUMN IF NOT EXISTS data_agendamento DATE;
+ALTER TABLE tb_controle ADD COLUMN IF NOT EXISTS hora_agendamento TIME;
+
+-- Preenche os registros existentes a partir das colunas texto
+UPDATE tb_controle
+SET data_agendamento = to_date(data, 'DD/MM/YYYY'),
+    hora_agendamento = CASE
+        WHEN horario ~ '^\d{1,2}:\d{2}' THEN substring(horario FROM '^\d{1,2}:\d{2}(?::\d{2})?')::time
+    END
+WHERE data_agendamento IS NULL
+  AND data ~ '^\d{2}/\d{2}/\d{4}$';
+
+-- Registros a enviar (status 0) e enviados aguardando resposta (status 1) por data
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_controle_status_data
+    ON tb_controle (status, data_agendamento)
+    WHERE status IN (0, 1);
+
+-- NOT EXISTS da fila: mesmo domínio e número com status 1 a partir de hoje
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_controle_contato_status_data
+    ON tb_controle (dominio_omniplus, numero_contato, status, data_agendamento);
+
+ANALYZE tb_controle;
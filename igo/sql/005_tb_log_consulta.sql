@@ -0,0 +1,26 @@
+-- Handix
+-- Índices da consulta de logs paginada por cursor (consultaLogs)
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 005_tb_log_consulta.sql
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Último status de cada agendamento (NOT EXISTS de um registro mais recente)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_agendamento_time
+    ON tb_log (codigo_agendamento, time DESC);
+
+-- Ordem da listagem e posição do cursor (nome_paciente, time, codigo_agendamento)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_nome_time_agendamento
+    ON tb_log (nome_paciente, time, codigo_agendamento);
+
+-- Filtros ILIKE '%...%' de nome do paciente e domínio
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_nome_paciente_trgm
+    ON tb_log USING gin (nome_paciente gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_dominio_omniplus_trgm
+    ON tb_log USING gin (dominio_omniplus gin_trgm_ops);
+
+-- Filtro por período
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_time
+    ON tb_log (time);
+
+ANALYZE tb_log;
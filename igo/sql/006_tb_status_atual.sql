@@ -0,0 +1,53 @@
+-- Handix
+-- Projeção do status atual de cada agendamento (último registro de tb_log)
+-- Mantida pelo middleware no mesmo comando que grava tb_log; consultada pelo consultaLogs
+-- Para recriar a partir de tb_log: python middleware.py reconstruir-status
+
+-- Mesmos tipos das colunas de tb_log
+CREATE TABLE IF NOT EXISTS tb_status_atual AS
+SELECT codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda
+FROM tb_log
+WITH NO DATA;
+
+-- Chave primária só na primeira execução (o script pode ser executado novamente)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'tb_status_atual'::regclass AND contype = 'p'
+    ) THEN
+        ALTER TABLE tb_status_atual ADD PRIMARY KEY (codigo_agendamento);
+    END IF;
+END $$;
+
+-- Carga inicial
+INSERT INTO tb_status_atual (codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda)
+SELECT DISTINCT ON (codigo_agendamento)
+       codigo_agendamento, time, dominio_omniplus, numero_contato, codigo_paciente, nome_paciente, tipo_agendamento, status, confirmacao, agenda
+FROM tb_log
+ORDER BY codigo_agendamento, time DESC
+ON CONFLICT (codigo_agendamento) DO NOTHING;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Ordem da listagem e posição do cursor (nome_paciente, time, codigo_agendamento)
+CREATE INDEX IF NOT EXISTS idx_status_atual_nome_time_agendamento
+    ON tb_status_atual (nome_paciente, time, codigo_agendamento);
+
+CREATE INDEX IF NOT EXISTS idx_status_atual_time
+    ON tb_status_atual (time);
+
+CREATE INDEX IF NOT EXISTS idx_status_atual_numero_contato
+    ON tb_status_atual (numero_contato);
+
+CREATE INDEX IF NOT EXISTS idx_status_atual_agenda
+    ON tb_status_atual (agenda);
+
+-- Filtros ILIKE '%...%' de nome do paciente e domínio
+CREATE INDEX IF NOT EXISTS idx_status_atual_nome_paciente_trgm
+    ON tb_status_atual USING gin (nome_paciente gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_status_atual_dominio_omniplus_trgm
+    ON tb_status_atual USING gin (dominio_omniplus gin_trgm_ops);
+
+ANALYZE tb_status_atual;
@@ -0,0 +1,47 @@
+-- Handix
+-- Particionamento mensal de tb_log pela coluna time
+-- A tabela atual vira a partição tb_log_legado (tudo antes do mês corrente);
+-- as partições mensais seguintes são criadas pelo middleware (gerenciar_particoes_log)
+-- Executar em janela de manutenção com o middleware parado
+
+BEGIN;
+
+ALTER TABLE tb_log RENAME TO tb_log_legado;
+
+CREATE TABLE tb_log (LIKE tb_log_legado INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    PARTITION BY RANGE (time);
+
+DO $$
+DECLARE
+    inicio_mes DATE := date_trunc('month', now())::date;
+    proximo_mes DATE := (date_trunc('month', now()) + INTERVAL '1 month')::date;
+BEGIN
+    -- A restrição evita a varredura da tabela no ATTACH PARTITION
+    EXECUTE format('ALTER TABLE tb_log_legado ADD CONSTRAINT ck_log_legado_time CHECK (time IS NOT NULL AND time < %L)', inicio_mes);
+    EXECUTE format('ALTER TABLE tb_log ATTACH PARTITION tb_log_legado FOR VALUES FROM (MINVALUE) TO (%L)', inicio_mes);
+
+    -- Partição do mês corrente; as próximas são criadas pelo middleware
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF tb_log FOR VALUES FROM (%L) TO (%L)',
+                   'tb_log_p' || to_char(inicio_mes, 'YYYY_MM'), inicio_mes, proximo_mes);
+END $$;
+
+-- Os índices de 005_tb_log_consulta.sql continuam com os mesmos nomes em tb_log_legado;
+-- renomeados, os índices de tb_log podem ser criados e os equivalentes do legado são anexados a eles
+ALTER INDEX IF EXISTS idx_log_agendamento_time RENAME TO idx_log_legado_agendamento_time;
+ALTER INDEX IF EXISTS idx_log_time RENAME TO idx_log_legado_time;
+
+-- A listagem e os filtros do consultaLogs usam tb_status_atual (006_tb_status_atual.sql):
+-- os índices de nome e trigram em tb_log só encareceriam cada inserção
+DROP INDEX IF EXISTS idx_log_nome_time_agendamento;
+DROP INDEX IF EXISTS idx_log_nome_paciente_trgm;
+DROP INDEX IF EXISTS idx_log_dominio_omniplus_trgm;
+
+-- Índices da tabela particionada, herdados por todas as partições (inclusive as criadas pelo middleware)
+-- Último registro de cada agendamento (reconstruir_status_atual)
+CREATE INDEX IF NOT EXISTS idx_log_agendamento_time ON tb_log (codigo_agendamento, time DESC);
+-- Consultas por período dentro das partições
+CREATE INDEX IF NOT EXISTS idx_log_time ON tb_log (time);
+
+COMMIT;
+
+ANALYZE tb_log;
@@ -0,0 +1,7 @@
+-- Handix
+-- Índice parcial dos registros enviados aguardando resposta do paciente (handle_return)
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 008_tb_controle_pendente_resposta.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_controle_pendente_resposta
+    ON tb_controle (numero_contato, url_origem)
+    WHERE status = 1;
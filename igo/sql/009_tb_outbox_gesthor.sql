@@ -0,0 +1,28 @@
+-- Handix
+-- Outbox das confirmações ao Gesthor (handle_return grava, processar_outbox_gesthor envia)
+-- situacao: pendente | enviado | falha (tentativas esgotadas)
+
+CREATE TABLE IF NOT EXISTS tb_outbox_gesthor (
+    id                 BIGSERIAL PRIMARY KEY,
+    controle_id        BIGINT NOT NULL,
+    dominio_gesthor    TEXT NOT NULL,
+    dominio_omniplus   TEXT NOT NULL,
+    numero_contato     BIGINT NOT NULL,
+    codigo_paciente    BIGINT NOT NULL,
+    nome_paciente      TEXT,
+    tipo_agendamento   TEXT,
+    codigo_agendamento BIGINT NOT NULL,
+    agenda             INTEGER,
+    confirmacao        TEXT NOT NULL,
+    situacao           TEXT NOT NULL DEFAULT 'pendente',
+    tentativas         INTEGER NOT NULL DEFAULT 0,
+    proxima_tentativa  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    ultimo_erro        TEXT,
+    criado_em          TIMESTAMPTZ NOT NULL DEFAULT now(),
+    enviado_em         TIMESTAMPTZ
+);
+
+-- Itens prontos para envio
+CREATE INDEX IF NOT EXISTS idx_outbox_gesthor_pendente
+    ON tb_outbox_gesthor (proxima_tentativa)
+    WHERE situacao = 'pendente';
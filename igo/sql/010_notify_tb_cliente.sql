@@ -0,0 +1,15 @@
+-- Handix
+-- Notifica os processos do middleware quando a configuração dos clientes muda
+-- O canal deve ser o mesmo de CONFIG_CLIENTES_CANAL_NOTIFY no config.py
+
+CREATE OR REPLACE FUNCTION fn_notificar_tb_cliente() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('tb_cliente_alterado', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tg_notificar_tb_cliente ON tb_cliente;
+CREATE TRIGGER tg_notificar_tb_cliente
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tb_cliente
+    FOR EACH STATEMENT EXECUTE FUNCTION fn_notificar_tb_cliente();
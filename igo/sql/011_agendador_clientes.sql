@@ -0,0 +1,15 @@
+-- Handix
+-- Agendador por cliente (main_scheduler)
+-- minuto_*: minuto de cada horário (hora_manha/hora_tarde/hora_noite continuam com a hora)
+-- tb_execucao_cliente: última execução agendada de cada período, usada na recuperação após reinício
+
+ALTER TABLE tb_cliente ADD COLUMN IF NOT EXISTS minuto_manha SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE tb_cliente ADD COLUMN IF NOT EXISTS minuto_tarde SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE tb_cliente ADD COLUMN IF NOT EXISTS minuto_noite SMALLINT NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS tb_execucao_cliente (
+    dominio_gesthor TEXT NOT NULL,
+    periodo         TEXT NOT NULL,
+    ultima_execucao TIMESTAMP NOT NULL,
+    PRIMARY KEY (dominio_gesthor, periodo)
+);
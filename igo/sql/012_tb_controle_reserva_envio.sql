@@ -0,0 +1,18 @@
+-- Handix
+-- Reserva dos registros da fila de envio (reservar_registros_envio)
+-- status 4: em envio ao Omniplus, reservado até reservado_ate; reservas vencidas voltam a ser reservadas
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 012_tb_controle_reserva_envio.sql
+
+ALTER TABLE tb_controle ADD COLUMN IF NOT EXISTS reservado_ate TIMESTAMPTZ;
+
+-- A fila passa a ler os status 0 e 4 além do 1 (NOT EXISTS do contato)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_controle_fila_envio
+    ON tb_controle (status, data_agendamento)
+    WHERE status IN (0, 1, 4);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_controle_status_data;
+
+-- Reservas vencidas (processo interrompido durante o envio)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_controle_reserva_vencida
+    ON tb_controle (reservado_ate)
+    WHERE status = 4;
@@ -0,0 +1,11 @@
+-- Handix
+-- Índice da ordem e do cursor do consultaLogs com nome do paciente nulo tratado como ''
+-- (a comparação de linha (nome_paciente, time, codigo_agendamento) > (...) é nula quando o nome é nulo)
+-- Executar fora de transação (CREATE INDEX CONCURRENTLY): psql -f 013_tb_status_atual_cursor.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_status_atual_cursor
+    ON tb_status_atual ((COALESCE(nome_paciente, '')), time, codigo_agendamento);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_status_atual_nome_time_agendamento;
+
+ANALYZE tb_status_atual;
@@ -0,0 +1,8 @@
+# Handix
+# Os testes importam middleware.py e config.py do diretório igo, como o servidor (python middleware.py)
+# Executar a partir de igo: python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
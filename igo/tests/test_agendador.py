@@ -0,0 +1,137 @@
+# Handix
+# Cálculo dos horários do agendador (main_scheduler) e versão da configuração dos clientes
+
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+
+import pytest
+
+import middleware
+from middleware import (ConfigClientes, SnapshotClientes, deslocamento_cliente, execucao_anterior_e_proxima,
+                        horarios_cliente, montar_agenda)
+
+
+def cliente(dominio='clinica.gesthor', ativo='sim', **horarios):
+    row = {'dominio_gesthor': dominio, 'ativo': ativo, 'bearer_gesthor': 'token-' + dominio, 'dominio_omniplus': 'omni-' + dominio,
+           'hora_manha': None, 'hora_tarde': None, 'hora_noite': None,
+           'minuto_manha': None, 'minuto_tarde': None, 'minuto_noite': None}
+    row.update(horarios)
+    return row
+
+
+@pytest.fixture(autouse=True)
+def sem_espalhamento(monkeypatch):
+    monkeypatch.setattr(middleware, 'AGENDADOR_ESPALHAMENTO', 0)
+    monkeypatch.setattr(middleware, 'AGENDADOR_RECUPERACAO', 3 * 3600)
+
+
+def test_anterior_e_proxima_antes_do_horario():
+    agora = datetime(2025, 5, 10, 7, 0)
+    assert execucao_anterior_e_proxima(8, 30, 0, agora) == (datetime(2025, 5, 9, 8, 30), datetime(2025, 5, 10, 8, 30))
+
+
+def test_anterior_e_proxima_depois_do_horario():
+    agora = datetime(2025, 5, 10, 9, 0)
+    assert execucao_anterior_e_proxima(8, 30, 0, agora) == (datetime(2025, 5, 10, 8, 30), datetime(2025, 5, 11, 8, 30))
+
+
+def test_anterior_e_proxima_no_horario_exato_conta_como_anterior():
+    agora = datetime(2025, 5, 10, 8, 30)
+    assert execucao_anterior_e_proxima(8, 30, 0, agora) == (agora, agora + timedelta(days=1))
+
+
+def test_anterior_e_proxima_com_deslocamento_e_virada_do_mes():
+    # 23:58 + 4 minutos de deslocamento passa da meia-noite do último dia do mês
+    agora = datetime(2025, 5, 31, 23, 59)
+    anterior, proxima = execucao_anterior_e_proxima(23, 58, 240, agora)
+    assert anterior == datetime(2025, 5, 31, 0, 2)
+    assert proxima == datetime(2025, 6, 1, 0, 2)
+
+
+def test_deslocamento_fixo_e_dentro_da_janela(monkeypatch):
+    monkeypatch.setattr(middleware, 'AGENDADOR_ESPALHAMENTO', 300)
+    deslocamento = deslocamento_cliente('clinica.gesthor')
+    assert deslocamento == deslocamento_cliente('clinica.gesthor')
+    assert 0 <= deslocamento < 300
+
+
+def test_horarios_cliente_ignora_repetidos_e_invalidos():
+    row = cliente(hora_manha=8, minuto_manha=0, hora_tarde=8, minuto_tarde=None, hora_noite=25)
+    assert horarios_cliente(row) == [('manhã', 8, 0)]
+
+
+def test_horarios_cliente_minuto_nulo_vale_zero():
+    row = cliente(hora_manha=7, hora_tarde=13, minuto_tarde=45)
+    assert horarios_cliente(row) == [('manhã', 7, 0), ('tarde', 13, 45)]
+
+
+def test_montar_agenda_sem_historico_agenda_a_proxima():
+    snapshot = SnapshotClientes([cliente(hora_manha=8)], 1)
+    agora = datetime(2025, 5, 10, 9, 0)
+    assert montar_agenda(snapshot, {}, agora) == [(datetime(2025, 5, 11, 8, 0), 'clinica.gesthor', 'manhã')]
+
+
+def test_montar_agenda_recupera_horario_perdido_recente():
+    snapshot = SnapshotClientes([cliente(hora_manha=8)], 1)
+    agora = datetime(2025, 5, 10, 10, 0)
+    execucoes = {('clinica.gesthor', 'manhã'): datetime(2025, 5, 9, 8, 0)}
+    assert montar_agenda(snapshot, execucoes, agora) == [(datetime(2025, 5, 10, 8, 0), 'clinica.gesthor', 'manhã')]
+
+
+def test_montar_agenda_nao_recupera_fora_da_janela():
+    snapshot = SnapshotClientes([cliente(hora_manha=8)], 1)
+    agora = datetime(2025, 5, 10, 11, 1)
+    execucoes = {('clinica.gesthor', 'manhã'): datetime(2025, 5, 9, 8, 0)}
+    assert montar_agenda(snapshot, execucoes, agora) == [(datetime(2025, 5, 11, 8, 0), 'clinica.gesthor', 'manhã')]
+
+
+def test_montar_agenda_nao_repete_horario_ja_executado():
+    snapshot = SnapshotClientes([cliente(hora_manha=8)], 1)
+    agora = datetime(2025, 5, 10, 9, 0)
+    execucoes = {('clinica.gesthor', 'manhã'): datetime(2025, 5, 10, 8, 0)}
+    assert montar_agenda(snapshot, execucoes, agora) == [(datetime(2025, 5, 11, 8, 0), 'clinica.gesthor', 'manhã')]
+
+
+def test_montar_agenda_ignora_inativos_e_ordena_pelo_momento():
+    snapshot = SnapshotClientes([
+        cliente('b.gesthor', hora_manha=9, hora_noite=19),
+        cliente('a.gesthor', hora_tarde=14),
+        cliente('c.gesthor', ativo='nao', hora_manha=6)
+    ], 1)
+    agenda = montar_agenda(snapshot, {}, datetime(2025, 5, 10, 8, 0))
+    ordem = [heapq.heappop(agenda) for _ in range(len(agenda))]
+    assert [(momento.hour, dominio) for momento, dominio, _ in ordem] == [(9, 'b.gesthor'), (14, 'a.gesthor'), (19, 'b.gesthor')]
+
+
+class BancoFalso:
+    """Pool mínimo com acquire() e fetch() para ConfigClientes.carregar."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def fetch(self, query):
+        return self.rows
+
+
+def test_versao_so_muda_quando_a_configuracao_muda():
+    async def cenario():
+        banco = BancoFalso([cliente(hora_manha=8)])
+        config = ConfigClientes()
+        primeira = await config.carregar(banco)
+        config.invalidar()
+        assert (await config.obter(banco)) is primeira
+        assert config.versao == 1
+        banco.rows = [cliente(hora_manha=9)]
+        config.invalidar()
+        assert (await config.obter(banco)).versao == 2
+    asyncio.run(cenario())
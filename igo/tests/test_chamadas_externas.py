@@ -0,0 +1,136 @@
+# Handix
+# Transições do circuit breaker por domínio (ControleDominio / ChamadaExterna)
+
+import asyncio
+
+import pytest
+
+import middleware
+from middleware import ControleDominio, ChamadaExterna, CircuitoAberto
+
+
+@pytest.fixture(autouse=True)
+def circuito(monkeypatch):
+    monkeypatch.setattr(middleware, 'CIRCUITO_FALHAS', 2)
+    monkeypatch.setattr(middleware, 'CIRCUITO_ABERTO', 30)
+    monkeypatch.setattr(middleware, 'CIRCUITO_SONDAS', 1)
+
+
+def controle():
+    return ControleDominio('gesthor', 'cliente.exemplo', taxa=1000, rajada=1000)
+
+
+def test_abre_apos_falhas_seguidas_e_recusa():
+    async def cenario():
+        dominio = controle()
+        for _ in range(2):
+            await dominio.entrar()
+            dominio.sair(False, 'falha')
+        assert dominio.estado == 'aberto'
+        with pytest.raises(CircuitoAberto):
+            await dominio.entrar()
+        assert dominio.contadores['recusadas'] == 1
+    asyncio.run(cenario())
+
+
+def test_sucesso_zera_falhas_seguidas_com_circuito_fechado():
+    async def cenario():
+        dominio = controle()
+        await dominio.entrar()
+        dominio.sair(False, 'falha')
+        await dominio.entrar()
+        dominio.sair(False, 'sucesso')
+        await dominio.entrar()
+        dominio.sair(False, 'falha')
+        assert dominio.estado == 'fechado'
+        assert dominio.falhas_seguidas == 1
+    asyncio.run(cenario())
+
+
+def test_sucesso_atrasado_nao_fecha_circuito_aberto():
+    async def cenario():
+        dominio = controle()
+        # Três chamadas em andamento antes da abertura; a última termina com sucesso depois
+        chamadas = [ChamadaExterna(dominio) for _ in range(3)]
+        for chamada in chamadas:
+            await chamada.__aenter__()
+        chamadas[0].resposta(500)
+        await chamadas[0].__aexit__(None, None, None)
+        chamadas[1].resposta(503)
+        await chamadas[1].__aexit__(None, None, None)
+        assert dominio.estado == 'aberto'
+        await chamadas[2].__aexit__(None, None, None)
+        assert dominio.estado == 'aberto'
+        with pytest.raises(CircuitoAberto):
+            await dominio.entrar()
+    asyncio.run(cenario())
+
+
+def test_sonda_bem_sucedida_fecha_circuito(monkeypatch):
+    async def cenario():
+        dominio = controle()
+        for _ in range(2):
+            await dominio.entrar()
+            dominio.sair(False, 'falha')
+        monkeypatch.setattr(middleware, 'CIRCUITO_ABERTO', 0)
+        sonda = ChamadaExterna(dominio)
+        await sonda.__aenter__()
+        assert sonda.sonda and dominio.estado == 'meio_aberto'
+        # Limite de sondas simultâneas atingido
+        with pytest.raises(CircuitoAberto):
+            await dominio.entrar()
+        await sonda.__aexit__(None, None, None)
+        assert dominio.estado == 'fechado'
+        assert dominio.falhas_seguidas == 0
+        assert dominio.sondas == 0
+    asyncio.run(cenario())
+
+
+def test_chamada_comum_nao_fecha_circuito_meio_aberto(monkeypatch):
+    async def cenario():
+        dominio = controle()
+        atrasada = ChamadaExterna(dominio)
+        await atrasada.__aenter__()
+        for _ in range(2):
+            await dominio.entrar()
+            dominio.sair(False, 'falha')
+        monkeypatch.setattr(middleware, 'CIRCUITO_ABERTO', 0)
+        sonda = ChamadaExterna(dominio)
+        await sonda.__aenter__()
+        await atrasada.__aexit__(None, None, None)
+        assert dominio.estado == 'meio_aberto'
+        await sonda.__aexit__(None, None, None)
+        assert dominio.estado == 'fechado'
+    asyncio.run(cenario())
+
+
+def test_sonda_com_falha_reabre_circuito(monkeypatch):
+    async def cenario():
+        dominio = controle()
+        for _ in range(2):
+            await dominio.entrar()
+            dominio.sair(False, 'falha')
+        monkeypatch.setattr(middleware, 'CIRCUITO_ABERTO', 0)
+        sonda = ChamadaExterna(dominio)
+        await sonda.__aenter__()
+        await sonda.__aexit__(asyncio.TimeoutError, asyncio.TimeoutError(), None)
+        assert dominio.estado == 'aberto'
+        assert dominio.contadores['aberturas'] == 2
+        assert dominio.contadores['timeouts'] == 1
+    asyncio.run(cenario())
+
+
+def test_429_e_cancelamento_nao_alteram_circuito():
+    async def cenario():
+        dominio = controle()
+        for _ in range(3):
+            chamada = ChamadaExterna(dominio)
+            await chamada.__aenter__()
+            chamada.resposta(429)
+            await chamada.__aexit__(None, None, None)
+        chamada = ChamadaExterna(dominio)
+        await chamada.__aenter__()
+        await chamada.__aexit__(asyncio.CancelledError, asyncio.CancelledError(), None)
+        assert dominio.estado == 'fechado'
+        assert dominio.falhas_seguidas == 0
+    asyncio.run(cenario())
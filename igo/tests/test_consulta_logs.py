@@ -0,0 +1,31 @@
+# Handix
+# Cursor da paginação do consultaLogs
+
+from datetime import datetime
+
+import pytest
+
+from middleware import codificar_cursor_logs, decodificar_cursor_logs
+
+
+def test_cursor_ida_e_volta():
+    row = {'nome_paciente': 'MARIA DA SILVA', 'time': datetime(2025, 3, 1, 14, 30, 5, 123456), 'codigo_agendamento': 98765}
+    assert decodificar_cursor_logs(codificar_cursor_logs(row)) == ('MARIA DA SILVA', row['time'], 98765)
+
+
+def test_cursor_com_nome_nulo_usa_texto_vazio():
+    row = {'nome_paciente': None, 'time': datetime(2025, 3, 1, 8, 0), 'codigo_agendamento': 1}
+    assert decodificar_cursor_logs(codificar_cursor_logs(row))[0] == ''
+
+
+def test_cursor_e_seguro_para_url():
+    row = {'nome_paciente': 'JOÃO ?/+ÇÃO', 'time': datetime(2025, 3, 1), 'codigo_agendamento': 2}
+    cursor = codificar_cursor_logs(row)
+    assert not set(cursor) & set('+/?&')
+    assert decodificar_cursor_logs(cursor)[0] == 'JOÃO ?/+ÇÃO'
+
+
+@pytest.mark.parametrize('cursor', ['', 'não-base64', 'WzFd'])
+def test_cursor_invalido_levanta_erro(cursor):
+    with pytest.raises(Exception):
+        decodificar_cursor_logs(cursor)
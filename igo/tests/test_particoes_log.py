@@ -0,0 +1,42 @@
+# Handix
+# Datas das partições mensais de tb_log
+
+import asyncio
+from datetime import date
+
+import pytest
+
+from middleware import inicio_do_mes, listar_particoes_log
+
+
+@pytest.mark.parametrize('data_base, meses, esperado', [
+    (date(2025, 5, 17), 0, date(2025, 5, 1)),
+    (date(2025, 5, 1), 1, date(2025, 6, 1)),
+    (date(2025, 11, 30), 2, date(2026, 1, 1)),
+    (date(2025, 12, 31), 1, date(2026, 1, 1)),
+    (date(2025, 1, 15), -1, date(2024, 12, 1)),
+    (date(2025, 3, 31), -24, date(2023, 3, 1)),
+    (date(2024, 2, 29), 12, date(2025, 2, 1)),
+])
+def test_inicio_do_mes(data_base, meses, esperado):
+    assert inicio_do_mes(data_base, meses) == esperado
+
+
+class ConexaoFalsa:
+    """Conexão mínima com fetch() para listar_particoes_log."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query):
+        return self.rows
+
+
+def test_listar_particoes_le_o_limite_superior():
+    rows = [
+        {'nome': 'tb_log_legado', 'limites': "FOR VALUES FROM (MINVALUE) TO ('2025-05-01 00:00:00')"},
+        {'nome': 'tb_log_p2025_05', 'limites': "FOR VALUES FROM ('2025-05-01 00:00:00') TO ('2025-06-01 00:00:00')"},
+        {'nome': 'tb_log_default', 'limites': 'DEFAULT'},
+    ]
+    particoes = asyncio.run(listar_particoes_log(ConexaoFalsa(rows)))
+    assert particoes == [('tb_log_legado', date(2025, 5, 1)), ('tb_log_p2025_05', date(2025, 6, 1))]